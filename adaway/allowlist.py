@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""Allowlist of domains that must never be blocked.
+
+Rules come from a local allowlist file and from "@@||domain^" exception rules
+found in the sources. An exact rule exempts one name; a suffix rule exempts a
+domain and all of its subdomains. Both live in hashed sets of bytes, so
+checking a candidate costs one lookup per label: "a.b.example.com" probes
+"a.b.example.com", "b.example.com", "example.com" and "com".
+"""
+
+
+def _key(domain):
+    if isinstance(domain, str):
+        domain = domain.encode("utf-8")
+    return domain.strip().lower()
+
+
+class Allowlist:
+    def __init__(self):
+        self.exact = set()
+        self.suffixes = set()
+        self.hits = 0  # Domains allows() has exempted so far
+
+    def add_exact(self, domain):
+        """Exempt exactly domain (str or bytes)."""
+        self.exact.add(_key(domain))
+
+    def add_suffix(self, domain):
+        """Exempt domain (str or bytes) and all of its subdomains."""
+        self.suffixes.add(_key(domain))
+
+    def add_rule(self, line):
+        """Add one allowlist file line: "domain" (exact) or "||domain^" / "@@||domain^" (suffix)."""
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            return
+        if line.startswith("@@"):
+            line = line[2:]
+        if line.startswith("||"):
+            domain = line[2:].split("^")[0].split("$")[0]
+            if domain:
+                self.add_suffix(domain)
+        else:
+            self.add_exact(line)
+
+    def load(self, path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                self.add_rule(line)
+
+    def __len__(self):
+        return len(self.exact) + len(self.suffixes)
+
+    def ancestors(self):
+        """{domain: exempted names strictly under it}, for outputs where one entry blocks a whole subtree."""
+        under = {}
+        for name in self.exact | self.suffixes:
+            dot = name.find(b".")
+            while dot != -1:
+                under.setdefault(name[dot + 1:], []).append(name)
+                dot = name.find(b".", dot + 1)
+        return under
+
+    def allows(self, domain):
+        """True if domain (bytes) is exempt from blocking."""
+        if domain in self.exact or domain in self.suffixes:
+            self.hits += 1
+            return True
+        suffixes = self.suffixes
+        dot = domain.find(b".")
+        while dot != -1:
+            domain = domain[dot + 1:]
+            if domain in suffixes:
+                self.hits += 1
+                return True
+            dot = domain.find(b".")
+        return False
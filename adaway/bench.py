@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""Offline benchmark of the adaway parse / merge / write pipeline.
+
+Generates reproducible synthetic corpora (hosts, adblock and mixed/garbage
+lines) and times each pipeline stage on them, reporting lines/s, MB/s and the
+peak Python heap (tracemalloc). Results are written as JSON, and compared
+against a previous run when BENCH_BASELINE points at one:
+
+    BENCH_SIZES=10000,1000000 BENCH_OUTPUT=before.json python3 bench.py
+    BENCH_BASELINE=before.json BENCH_OUTPUT=after.json python3 bench.py
+"""
+import json
+import os
+import platform
+import random
+import string
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from collections import deque
+from datetime import datetime
+
+import main
+from domainset import DomainSet
+from provenance import Provenance
+
+BENCH_SIZES = os.getenv("BENCH_SIZES", "10000,100000,1000000")  # Lines per corpus; up to 10M is reasonable
+BENCH_REPEAT = int(os.getenv("BENCH_REPEAT", "3"))  # Timed runs per stage, best one is kept
+BENCH_SEED = int(os.getenv("BENCH_SEED", "1"))
+BENCH_CORPUS_DIR = os.getenv("BENCH_CORPUS_DIR", "bench_corpora")  # Generated corpora are reused
+BENCH_OUTPUT = os.getenv("BENCH_OUTPUT", "bench_results.json")
+BENCH_BASELINE = os.getenv("BENCH_BASELINE")  # Earlier results file to compare against
+
+CORPUS_KINDS = ["hosts", "adblock", "mixed"]
+TLDS = ["com", "net", "org", "io", "de", "co.uk", "info", "xyz", "ru", "com.br"]
+DUPLICATE_RATE = 0.3  # Share of lines repeating a domain already seen in the corpus
+
+
+# ---------------- Corpora ----------------
+def random_domain(rng):
+    labels = [
+        "".join(rng.choices(string.ascii_lowercase + string.digits, k=rng.randint(3, 12)))
+        for _ in range(rng.randint(1, 3))
+    ]
+    if rng.random() < 0.05:
+        labels[0] = labels[0][:2] + "-" + labels[0][2:]
+    return ".".join(labels) + "." + rng.choice(TLDS)
+
+
+def garbage_line(rng):
+    return rng.choice([
+        "",
+        "   ",
+        "# " + random_domain(rng),
+        "! Title: synthetic list",
+        "[Adblock Plus 2.0]",
+        "/banner/*/ads.js",
+        "##.ad-container",
+        random_domain(rng) + "###sponsored",
+        "||" + random_domain(rng) + "/path/*.gif",
+        "@@||" + random_domain(rng) + "^$document",
+        "127.0.0.1 localhost",
+        "::1 ip6-localhost",
+        "0.0.0.0 " + random_domain(rng) + " # trailing comment",
+        "\tmünchen-" + random_domain(rng),
+        "not a domain at all",
+    ])
+
+
+def corpus_line(kind, domain, rng):
+    if kind == "hosts":
+        if rng.random() < 0.02:
+            return "# " + domain
+        return ("0.0.0.0 " if rng.random() < 0.9 else "127.0.0.1 ") + domain
+    if kind == "adblock":
+        roll = rng.random()
+        if roll < 0.02:
+            return "! " + domain
+        if roll < 0.05:
+            return "|https://" + domain + "^"
+        return "||" + domain + "^"
+    roll = rng.random()
+    if roll < 0.3:
+        return garbage_line(rng)
+    if roll < 0.55:
+        return "0.0.0.0 " + domain
+    if roll < 0.8:
+        return "||" + domain + "^"
+    return domain.upper() if rng.random() < 0.1 else domain
+
+
+def corpus_path(kind, lines):
+    return os.path.join(BENCH_CORPUS_DIR, f"{kind}-{lines}-{BENCH_SEED}.txt")
+
+
+def generate_corpus(kind, lines):
+    """Write (once) and return the path of a deterministic corpus of the given kind and size."""
+    path = corpus_path(kind, lines)
+    if os.path.isfile(path):
+        return path
+    os.makedirs(BENCH_CORPUS_DIR, exist_ok=True)
+    rng = random.Random(f"{kind}-{lines}-{BENCH_SEED}")
+    seen = []
+    with main.atomic_write(path) as f:
+        batch = []
+        for _ in range(lines):
+            if seen and rng.random() < DUPLICATE_RATE:
+                domain = rng.choice(seen)
+            else:
+                domain = random_domain(rng)
+                seen.append(domain)
+            batch.append(corpus_line(kind, domain, rng))
+            if len(batch) >= main.WRITE_BATCH:
+                f.write(("\n".join(batch) + "\n").encode("utf-8"))
+                batch = []
+        if batch:
+            f.write(("\n".join(batch) + "\n").encode("utf-8"))
+    return path
+
+
+# ---------------- Measurement ----------------
+def measure(stage, corpus, lines, size, run):
+    """Time run() (best of BENCH_REPEAT), then repeat it once under tracemalloc for the peak heap."""
+    best = float("inf")
+    for _ in range(BENCH_REPEAT):
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    result = {
+        "stage": stage,
+        "corpus": corpus,
+        "lines": lines,
+        "bytes": size,
+        "seconds": round(best, 6),
+        "lines_per_s": round(lines / best) if best else None,
+        "mb_per_s": round(size / best / 1e6, 2) if best else None,
+        "peak_mb": round(peak / 1e6, 2),
+    }
+    print(
+        f"  {stage:<24} {corpus:<8} {lines:>10} lines  {best:9.3f}s  "
+        f"{result['lines_per_s'] or 0:>12,} lines/s  {result['mb_per_s'] or 0:8.2f} MB/s  "
+        f"peak {result['peak_mb']:8.2f} MB"
+    )
+    return result
+
+
+def consume(iterable):
+    deque(iterable, maxlen=0)
+
+
+def bench_size(lines, workdir):
+    results = []
+    parsed = {}
+    for kind in CORPUS_KINDS:
+        path = generate_corpus(kind, lines)
+        with open(path, "rb") as f:
+            data = f.read()
+        size = len(data)
+        text = data.decode("utf-8")
+        results.append(measure("parse_host_bytes", kind, lines, size, lambda: main.parse_host_bytes(data)))
+        results.append(measure(
+            "parse_host_lines", kind, lines, size, lambda: main.parse_host_lines(text.split("\n"))
+        ))
+        if kind == "adblock":
+            results.append(measure(
+                "normalize_adblock_line", kind, lines, size,
+                lambda: consume(map(main.normalize_adblock_line, text.split("\n"))),
+            ))
+        parsed[kind] = main.parse_host_bytes(data)
+
+    # Merge and write work on the union of the three corpora, like three sources
+    sources = [(kind, main.domains_to_blob(domains)) for kind, domains in parsed.items()]
+    entries = sum(map(len, parsed.values()))
+    size = sum(len(blob) for _, blob in sources)
+    main.PARSE_CACHE_DIR = os.path.join(workdir, "parse_cache")
+    for kind, blob in sources:
+        main.save_parsed_blob(kind, blob, b"")
+    cached = [(kind, kind) for kind, _ in sources]
+
+    def set_union():
+        merged = set()
+        for domains in parsed.values():
+            merged.update(domains)
+        return sorted(merged)
+
+    def domainset_merge():
+        merged = DomainSet()
+        for _, blob in sources:
+            merged.merge_sorted_blob(blob)
+        consume(merged.iter_bytes())
+
+    results.append(measure("merge_set_sorted", "all", entries, size, set_union))
+    results.append(measure("merge_domainset", "all", entries, size, domainset_merge))
+    results.append(measure("merge_kway", "all", entries, size, lambda: consume(main.iter_merged_sources(cached, {}))))
+    results.append(measure(
+        "merge_kway_provenance", "all", entries, size,
+        lambda: consume(Provenance(kind for kind, _ in cached).track(main.iter_merged_masks(cached, {}))),
+    ))
+
+    merged = list(main.iter_merged_sources(cached, {}))
+    size = sum(map(len, merged)) + len(merged)
+    formats = {"write_hosts": [main.FORMATS["hosts"]], "write_all_formats": list(main.FORMATS.values())}
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        for stage, stage_formats in formats.items():
+            results.append(measure(
+                stage, "all", len(merged), size,
+                lambda: main.write_outputs(merged, stage_formats, {}, "bench"),
+            ))
+    finally:
+        os.chdir(cwd)
+    return results
+
+
+# ---------------- Report ----------------
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    before = {(r["stage"], r["corpus"], r["lines"]): r for r in baseline.get("results", [])}
+    print(f"Compared to {baseline_path} ({baseline.get('commit') or 'unknown commit'}):")
+    for r in results:
+        old = before.get((r["stage"], r["corpus"], r["lines"]))
+        if not old or not old["seconds"]:
+            continue
+        change = (r["seconds"] / old["seconds"] - 1) * 100
+        print(f"  {r['stage']:<24} {r['corpus']:<8} {r['lines']:>10} lines  time {change:+7.1f}%  "
+              f"peak {old['peak_mb']:.2f} -> {r['peak_mb']:.2f} MB")
+
+
+def main_bench():
+    sizes = [int(size) for size in BENCH_SIZES.split(",") if size.strip()]
+    results = []
+    with tempfile.TemporaryDirectory(prefix="adaway-bench-") as workdir:
+        for lines in sizes:
+            print(f"Corpus size {lines} lines:")
+            results.extend(bench_size(lines, workdir))
+    report = {
+        "commit": git_commit(),
+        "generated": datetime.utcnow().strftime("%Y-%m-%d %H:%M UTC"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": BENCH_SEED,
+        "repeat": BENCH_REPEAT,
+        "results": results,
+    }
+    with open(BENCH_OUTPUT, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {BENCH_OUTPUT}")
+    if BENCH_BASELINE:
+        compare(results, BENCH_BASELINE)
+
+
+if __name__ == "__main__":
+    main_bench()
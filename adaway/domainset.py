@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""Compact, sorted set of domains.
+
+A plain set[str] costs well over 100 bytes per domain. DomainSet keeps its
+contents as sorted runs: one bytes arena of newline-terminated UTF-8 domains
+plus an array('I') of start offsets, i.e. roughly len(domain) + 5 bytes per
+entry. New domains are buffered in a small pending set and folded into runs
+in bulk. Large runs are merged with a streaming k-way merge, so compaction
+never materialises more than one Python object per input run at a time.
+"""
+import heapq
+from array import array
+from bisect import bisect_left
+from io import BytesIO
+from itertools import accumulate, chain, islice
+
+PENDING_LIMIT = 1 << 16  # Buffered single adds before they are sorted into a run
+BATCH_SIZE = 1 << 16  # Entries copied into a new run per C-level join
+SORT_MERGE_LIMIT = 1 << 18  # Runs up to this many entries are merged in C by Timsort
+
+
+def _entry(domain):
+    """Run entry for a domain given as str or UTF-8 bytes."""
+    return (domain.encode("utf-8") if isinstance(domain, str) else domain) + b"\n"
+
+
+class _Run:
+    """Sorted, duplicate-free domains in one newline-terminated bytes arena."""
+
+    __slots__ = ("blob", "offsets")
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets  # start of each entry, plus a final sentinel == len(blob)
+
+    @classmethod
+    def from_sorted(cls, items):
+        """Build a run from sorted, newline-terminated bytes, dropping adjacent duplicates."""
+        out = bytearray()
+        offsets = array("I")
+        items = iter(items)
+        last = None
+        while True:
+            # Duplicates are adjacent, so dict.fromkeys() drops them within a batch
+            batch = list(dict.fromkeys(islice(items, BATCH_SIZE)))
+            if not batch:
+                break
+            if batch[0] == last:
+                del batch[0]
+                if not batch:
+                    continue
+            offsets.extend(accumulate(islice(map(len, batch), len(batch) - 1), initial=len(out)))
+            out += b"".join(batch)
+            last = batch[-1]
+        offsets.append(len(out))
+        return cls(bytes(out), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        return iter(BytesIO(self.blob))
+
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]]
+
+    def __contains__(self, item):
+        i = bisect_left(self, item, 0, len(self))
+        return i < len(self) and self[i] == item
+
+
+class DomainSet:
+    """Memory-compact set of domain names with sorted iteration.
+
+    Supports add(), update() for bulk merges (of str or UTF-8 bytes), merge_sorted_blob() for
+    pre-sorted newline-joined bytes (the parse-cache format), membership,
+    len() and iteration in sorted order. Iterating yields str; iter_bytes()
+    yields the raw b"domain\\n" entries.
+    """
+
+    def __init__(self, domains=()):
+        self._runs = []
+        self._pending = set()
+        self.update(domains)
+
+    def add(self, domain):
+        self._pending.add(_entry(domain))
+        if len(self._pending) >= PENDING_LIMIT:
+            self._flush()
+
+    def update(self, domains):
+        domains = domains if isinstance(domains, (set, frozenset, list, tuple)) else list(domains)
+        if len(domains) < PENDING_LIMIT:
+            for domain in domains:
+                self.add(domain)
+            return
+        self._push(_Run.from_sorted(sorted(map(_entry, domains))))
+
+    def merge_sorted_blob(self, blob):
+        """Merge sorted, duplicate-free, newline-joined UTF-8 domains without re-sorting them."""
+        if not blob:
+            return
+        if not blob.endswith(b"\n"):
+            blob += b"\n"
+        self._push(_Run.from_sorted(BytesIO(blob)))
+
+    def __len__(self):
+        self._compact()
+        return len(self._runs[0]) if self._runs else 0
+
+    def __contains__(self, domain):
+        item = _entry(domain)
+        return item in self._pending or any(item in run for run in self._runs)
+
+    def iter_bytes(self):
+        """Sorted b"domain\\n" entries."""
+        self._compact()
+        return iter(self._runs[0]) if self._runs else iter(())
+
+    def __iter__(self):
+        for item in self.iter_bytes():
+            yield item[:-1].decode("utf-8")
+
+    def _flush(self):
+        if self._pending:
+            pending, self._pending = self._pending, set()
+            self._push(_Run.from_sorted(sorted(pending)))
+
+    def _push(self, run):
+        # Keep run sizes roughly geometric (largest first) so each domain takes
+        # part in O(log n) merges and the number of runs stays small.
+        self._runs.append(run)
+        while len(self._runs) > 1 and len(self._runs[-1]) * 2 >= len(self._runs[-2]):
+            newer = self._runs.pop()
+            older = self._runs.pop()
+            self._runs.append(_merge_runs([older, newer]))
+
+    def _compact(self):
+        self._flush()
+        if len(self._runs) > 1:
+            runs, self._runs = self._runs, []
+            self._runs.append(_merge_runs(runs))
+
+
+def _merge_runs(runs):
+    if sum(map(len, runs)) <= SORT_MERGE_LIMIT:
+        # Timsort finds the pre-sorted runs and merges them in linear time;
+        # fine while the temporary list of entries stays small
+        return _Run.from_sorted(sorted(chain(*runs)))
+    return _Run.from_sorted(heapq.merge(*runs))
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""Trie over reversed domain labels, for subdomain-aware de-duplication.
+
+"x.ads.example.com" is stored along the path com -> example -> ads -> x. A
+blocked domain ends its path in the BLOCKED marker instead of a child dict,
+so once "example.com" is in the trie everything below it is dropped and
+never stored again: the trie only ever holds the minimal covering set.
+"""
+
+BLOCKED = object()  # Terminal marker; a blocked node has no children worth keeping
+
+
+class DomainTrie:
+    def __init__(self):
+        self._root = {}
+
+    def add(self, domain):
+        """Block domain (bytes) and, implicitly, all of its subdomains."""
+        labels = domain.split(b".")
+        node = self._root
+        for i in range(len(labels) - 1, 0, -1):
+            child = node.get(labels[i])
+            if child is BLOCKED:
+                return  # An ancestor already covers it
+            if child is None:
+                child = node[labels[i]] = {}
+            node = child
+        node[labels[0]] = BLOCKED  # Replaces (and frees) any subtree of now-covered subdomains
+
+    def has_blocked_ancestor(self, domain):
+        """True if a proper parent domain of domain (bytes) is blocked."""
+        labels = domain.split(b".")
+        node = self._root
+        for i in range(len(labels) - 1, 0, -1):
+            node = node.get(labels[i])
+            if node is None:
+                return False
+            if node is BLOCKED:
+                return True
+        return False
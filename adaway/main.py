@@ -1,29 +1,95 @@
 #!/usr/bin/env python3
 import csv
+import gzip
+import hashlib
+import heapq
 import os
 import re
+import shutil
 import sys
 import json
+import multiprocessing
+import time
 import traceback
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import ExitStack, contextmanager
 from datetime import datetime, timedelta
-from io import StringIO
+from itertools import filterfalse, islice, repeat
+from operator import methodcaller
 
 import matplotlib.pyplot as plt
 import requests
 
+try:
+    import resource
+except ImportError:  # Not on Windows; peak memory is then left out of the run report
+    resource = None
+
+try:
+    import zstandard
+except ImportError:  # .zst artifacts are skipped without it
+    zstandard = None
+
+from allowlist import Allowlist
+from domainset import DomainSet
+from domaintrie import DomainTrie
+from provenance import Provenance
+from sketch import Sketch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from fetcher import fetch_all  # noqa: E402  (shared with skynet)
+
 # Load environment variables
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 CHAT_ID = os.getenv("CHAT_ID")
 SOURCES_FILE = os.getenv("SOURCES_FILE", "sources.txt")  # Default: sources.txt in repo
-
-MAX_THREADS = 8  # Number of parallel downloads
+ALLOWLIST_FILE = os.getenv("ALLOWLIST_FILE", "allowlist.txt")  # Domains never blocked; optional
+# Names from the boilerplate of hosts files; blocking them would break loopback on the resolvers
+HOSTS_BOILERPLATE = [
+    "localhost", "localhost.localdomain", "local", "broadcasthost", "0.0.0.0",
+    "ip6-localhost", "ip6-loopback", "ip6-localnet", "ip6-mcastprefix", "ip6-allnodes", "ip6-allrouters",
+    "ip6-allhosts",
+]
 
 SOURCE_LIST_URL = "https://v.firebog.net/hosts/lists.php?type=tick"
 
 COUNTS_HISTORY_FILE = "counts_history.csv"
 GRAPH_FILE = "counts_graph.png"
 ERROR_TRACKER_FILE = "error_tracker.json"
+RUN_REPORT_FILE = "run_report.json"  # Per-stage and per-source timings of the last run
+REPORT_TELEGRAM = os.getenv("REPORT_TELEGRAM", "0") == "1"  # Also send the report's summary line
+UNIFIED_HOSTS_FILE = "unified_hosts.txt"
+BUILD_SNAPSHOT_FILE = "build_domains.txt"  # Sorted domains of the last build, the base for the next delta
+DELTA_FILE = "unified_delta.txt"
+MANIFEST_FILE = "manifest.json"
+PROVENANCE_FILE = "provenance.json"  # Per-source unique contribution and overlap of the last build
+# domain<TAB>source bitmask of every merged domain; "" skips it
+PROVENANCE_INDEX_FILE = os.getenv("PROVENANCE_INDEX_FILE", "provenance.tsv.gz")
+OVERLAP_FILE = "overlap.json"  # Sketch-based size and Jaccard estimates per source
+REDUNDANT_CONTAINMENT = 0.9  # Report a source when at least this share of it is estimated to be in another one
+HTTP_CACHE_DIR = os.getenv("HTTP_CACHE_DIR", "http_cache")  # Persisted between runs by the workflow
+PARSE_CACHE_DIR = os.getenv("PARSE_CACHE_DIR", "parse_cache")
+PARSE_CACHE_VERSION = 2  # Bump whenever the parser's output changes, so older cached parses are not reused
+STREAM_DOWNLOADS = os.getenv("STREAM_DOWNLOADS", "1") == "1"  # Spool bodies to disk as they arrive
+READ_CHUNK_SIZE = 1 << 20
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", "0"))  # >0: parse in a process pool (-1: one per core)
+# "kway": stream-merge the per-source sorted lists; "set": collect everything in a DomainSet
+MERGE_STRATEGY = os.getenv("MERGE_STRATEGY", "kway")
+WRITE_BATCH = 1 << 16  # Domains joined into a single write() call
+OUTPUT_FORMATS = os.getenv("OUTPUT_FORMATS", "hosts,dnsmasq,unbound,adguard,rpz,domains")  # Comma-separated
+OUTPUT_COMPRESSION = os.getenv("OUTPUT_COMPRESSION", "gz,zst")  # Pre-compressed variants of every output
+ZSTD_LEVEL = 12
+# Every output keeps a zstd stream open during the merge. Level 12's defaults are sized for
+# input of unknown length (32 MB hash table, 16 MB chain table, 4 MB window per stream); sorted
+# lists only match nearby lines, so 1 MB tables and window cost nothing in ratio.
+ZSTD_WINDOW_LOG = 20
+ZSTD_HASH_LOG = 18
+ZSTD_CHAIN_LOG = 18
+INDEX_GZIP_LEVEL = 6  # The provenance index is internal; level 9 costs ~6x the time for ~5% less
+# Drop entries already covered by a blocked parent domain from formats that block whole zones
+COMPACT_SUBDOMAINS = os.getenv("COMPACT_SUBDOMAINS", "0") == "1"
+# >1: also write every format with only the domains at least this many sources agree on (name.minK.ext)
+MIN_SOURCES = int(os.getenv("MIN_SOURCES", "0"))
 
 
 # ---------------- Telegram ----------------
@@ -87,13 +153,95 @@ def record_result(url, success, tracker):
     tracker[url] = entry
 
 
+# ---------------- Run report ----------------
+def peak_rss_mb():
+    if resource is None:
+        return None
+    kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # KiB on Linux
+    return round(kb / 1024, 1)
+
+
+class RunReport:
+    """Wall/CPU time and peak memory per stage, plus download and parse figures per source."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = []
+        self.sources = {}
+
+    @contextmanager
+    def stage(self, name):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.stages.append({
+                "stage": name,
+                "seconds": round(time.perf_counter() - wall, 3),
+                "cpu_seconds": round(time.process_time() - cpu, 3),
+                "peak_rss_mb": peak_rss_mb(),
+            })
+
+    def source(self, url):
+        return self.sources.setdefault(url, {})
+
+    def fetched(self, result):
+        entry = self.source(result.url)
+        entry["status"] = result.status
+        entry["error"] = result.error
+        entry.update({key: round(value, 3) if isinstance(value, float) else value
+                      for key, value in result.timing.items()})
+
+    def parsed(self, url, lines, seconds, domains, cached=False):
+        self.source(url)["parse"] = {
+            "lines": lines,
+            "seconds": round(seconds, 3),
+            "lines_per_s": round(lines / seconds) if seconds else None,
+            "domains": domains,
+            "cached": cached,
+        }
+
+    def summary(self, total_unique):
+        line = f"{total_unique} domains in {time.perf_counter() - self.started:.1f}s"
+        line += " (" + ", ".join(f"{s['stage']} {s['seconds']:.1f}s" for s in self.stages) + ")"
+        timed = [(entry["elapsed"], url) for url, entry in self.sources.items() if "elapsed" in entry]
+        if timed:
+            elapsed, url = max(timed)
+            line += f", slowest source {url} {elapsed:.1f}s"
+        return line
+
+    def save(self, total_unique):
+        report = {
+            "generated": datetime.utcnow().strftime("%Y-%m-%d %H:%M UTC"),
+            "total_seconds": round(time.perf_counter() - self.started, 3),
+            "peak_rss_mb": peak_rss_mb(),
+            "unique_domains": total_unique,
+            "stages": self.stages,
+            "sources": self.sources,
+        }
+        with open(RUN_REPORT_FILE, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+REPORT = RunReport()
+
+
+def publish_run_report(total_unique):
+    REPORT.save(total_unique)
+    summary = REPORT.summary(total_unique)
+    print(f"Run report written to {RUN_REPORT_FILE}: {summary}")
+    if REPORT_TELEGRAM:
+        send_telegram_message(f"Blocklist build: {summary}")
+
+
 # ---------------- Sources ----------------
 def update_sources_file():
     try:
-        print(f"Fetching source list from {SOURCE_LIST_URL}")
-        resp = requests.get(SOURCE_LIST_URL, timeout=20)
-        resp.raise_for_status()
-        content = resp.text
+        # Through fetch_all() so the source list is recorded and replayed with the lists themselves
+        [result] = fetch_all([SOURCE_LIST_URL])
+        if not result.ok:
+            raise RuntimeError(result.error)
+        content = result.text
 
         with open(SOURCES_FILE, "w", encoding="utf-8") as f:
             f.write(content)
@@ -119,32 +267,276 @@ def update_sources_file():
 
 
 def load_urls(file_path):
-    urls = []
+    """Source URLs in file order, each listed once.
+
+    A list in both firebog's list and additional_sources.txt would otherwise be
+    fetched twice (into the same cache files) and count as two sources agreeing
+    on every domain.
+    """
+    urls = {}
     try:
         with open(file_path, "r", encoding="utf-8") as f:
             for line in f:
                 line = line.strip()
                 if line and not line.startswith("#"):
-                    urls.append(line)
+                    urls.setdefault(line)
     except FileNotFoundError:
         error_message = f"[ERROR] Sources file not found: {file_path}"
         print(error_message)
         send_telegram_message(error_message)
         sys.exit(1)
-    return urls
+    return list(urls)
 
 
-# ---------------- Download & Parse ----------------
-def download_list(url):
+# ---------------- HTTP cache ----------------
+def cache_paths(url):
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    return os.path.join(HTTP_CACHE_DIR, f"{key}.json"), os.path.join(HTTP_CACHE_DIR, f"{key}.body")
+
+
+def load_cache_meta(url):
+    """Return the cached validators for a URL, or None if there is no usable entry."""
+    meta_path, body_path = cache_paths(url)
+    if not os.path.isfile(meta_path) or not os.path.isfile(body_path):
+        return None
     try:
-        print(f"Downloading: {url}")
-        resp = requests.get(url, timeout=20)
-        resp.raise_for_status()
-        return url, resp.text
-    except Exception as e:
-        error_message = f"[ERROR] Could not download {url}: {e}"
-        print(error_message)
-        return url, ""
+        with open(meta_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"[WARNING] Ignoring unreadable cache entry for {url}: {e}")
+        return None
+
+
+def load_cached_body(url):
+    _, body_path = cache_paths(url)
+    try:
+        with open(body_path, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def is_cacheable(headers):
+    return bool(headers.get("ETag") or headers.get("Last-Modified"))
+
+
+def spool_path(url):
+    return cache_paths(url)[1] + ".spool"
+
+
+def open_cached_body(url):
+    """Open a temp file for a new cache body; commit it with save_cache_meta()."""
+    os.makedirs(HTTP_CACHE_DIR, exist_ok=True)
+    _, body_path = cache_paths(url)
+    return open(body_path + ".tmp", "wb")
+
+
+def save_cache_meta(url, headers):
+    # Body first, metadata last: a half-written entry has no validators and is never trusted
+    meta_path, body_path = cache_paths(url)
+    os.replace(body_path + ".tmp", body_path)
+    with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+        meta = {"url": url, "etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified")}
+        json.dump(meta, f, indent=2)
+    os.replace(meta_path + ".tmp", meta_path)
+
+
+def save_cached_response(url, headers, body):
+    if not is_cacheable(headers):
+        return  # Nothing to revalidate with, don't bother caching
+    with open_cached_body(url) as f:
+        f.write(body)
+    save_cache_meta(url, headers)
+
+
+def conditional_headers(url):
+    meta = load_cache_meta(url)
+    headers = {}
+    if meta:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+    return headers
+
+
+# ---------------- Download & Parse ----------------
+def download_lists(urls):
+    """Download all lists, revalidating against the on-disk cache.
+
+    Yields (url, content, status) as each download completes; content is raw bytes, empty on failure.
+    """
+    for result in fetch_all(urls, headers_for=conditional_headers):
+        url = result.url
+        REPORT.fetched(result)
+        if not result.ok:
+            print(f"[ERROR] Could not download {url}: {result.error}")
+            yield url, b"", result.status
+            continue
+        if result.status == 304:
+            cached_body = load_cached_body(url)
+            if cached_body is None:
+                print(f"[ERROR] {url} not modified but cached copy is missing")
+                yield url, b"", None
+                continue
+            print(f"Not modified, using cached copy: {url}")
+            yield url, cached_body, 304
+            continue
+        save_cached_response(url, result.headers, result.content)
+        yield url, result.content, result.status
+
+
+class StreamingDownload:
+    """fetch_all() sink that spools a list to disk while it downloads.
+
+    Raw byte chunks are written to the HTTP cache (or, without validators to
+    revalidate with, to a spool file next to it) and hashed on the way, so the
+    full body is never held in memory and the event loop only does cheap work
+    per chunk. Parsing happens on the consumer side, and only when the parse
+    cache has nothing for the content hash. close() returns (digest, path of
+    the body, size); a spool file is the caller's to remove.
+    """
+
+    def __init__(self, url, headers):
+        self.url = url
+        self.headers = headers
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._cacheable = is_cacheable(headers)
+        if self._cacheable:
+            self._file = open_cached_body(url)
+        else:
+            os.makedirs(HTTP_CACHE_DIR, exist_ok=True)
+            self._file = open(spool_path(url), "wb")
+
+    def feed(self, chunk):
+        self._file.write(chunk)
+        self._hash.update(chunk)
+        self.size += len(chunk)
+
+    def close(self):
+        self._file.close()
+        if self._cacheable:
+            save_cache_meta(self.url, self.headers)
+            path = cache_paths(self.url)[1]
+        else:
+            path = spool_path(self.url)
+        return self._hash.hexdigest(), path, self.size
+
+    def abort(self):
+        self._file.close()
+        os.remove(self._file.name)
+
+
+def iter_file_chunks(path):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b""):
+            yield chunk
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    for chunk in iter_file_chunks(path):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parse_cached_body(url):
+    """Parse a 304'd source from the HTTP cache without loading it whole.
+
+    Returns (digest, number of domains, exceptions).
+    """
+    return parse_body_file(url, cache_paths(url)[1])
+
+
+def parse_body_file(url, body_path, digest=None):
+    """parse_hosts_cached() for a body on disk, read in chunks. Returns (digest, number of domains, exceptions)."""
+    if digest is None:
+        digest = file_digest(body_path)
+    cached = load_cached_parse(digest, url)
+    if cached is not None:
+        return (digest, *cached)
+    lines = 0
+
+    def counted_chunks():
+        nonlocal lines
+        for chunk in iter_file_chunks(body_path):
+            lines += chunk.count(b"\n")
+            yield chunk
+
+    exceptions = set()
+    start = time.perf_counter()
+    domains = parse_host_chunks(counted_chunks(), exceptions=exceptions)
+    REPORT.parsed(url, lines, time.perf_counter() - start, len(domains))
+    save_parsed_domains(digest, domains, exceptions)
+    return digest, len(domains), exceptions
+
+
+def download_and_parse(urls):
+    """Yield (url, digest, count, exceptions) for each source as it completes.
+
+    count (the number of domains) and exceptions are None on failure. The
+    domains themselves are in the parse cache under digest. exceptions holds
+    the domains of "@@||domain^" allow rules found in the source.
+    """
+    if PARSE_WORKERS:
+        yield from download_and_parse_parallel(urls)
+        return
+
+    if not STREAM_DOWNLOADS:
+        for url, content, status in download_lists(urls):
+            if not content and status != 304:
+                yield url, None, None, None
+                continue
+            try:
+                digest, count, exceptions = parse_hosts_cached(content, url)
+            except Exception as e:
+                msg = f"[ERROR] Exception processing {url}: {e}"
+                print(msg)
+                send_telegram_message(msg)
+                yield url, None, None, None
+                continue
+            yield url, digest, count, exceptions
+        return
+
+    for result in fetch_all(urls, headers_for=conditional_headers, sink_for=StreamingDownload):
+        url = result.url
+        REPORT.fetched(result)
+        if not result.ok:
+            print(f"[ERROR] Could not download {url}: {result.error}")
+            yield url, None, None, None
+            continue
+        if result.status == 304:
+            try:
+                digest, count, exceptions = parse_cached_body(url)
+            except OSError as e:
+                print(f"[ERROR] {url} not modified but cached copy is unreadable: {e}")
+                yield url, None, None, None
+                continue
+            print(f"Not modified, using cached copy: {url}")
+            yield url, digest, count, exceptions
+            continue
+        digest, body_path, size = result.value
+        try:
+            if not size:  # Same as an empty body in the buffered path
+                print(f"[ERROR] {url} returned an empty body")
+                yield url, None, None, None
+                continue
+            digest, count, exceptions = parse_body_file(url, body_path, digest)
+        except Exception as e:
+            msg = f"[ERROR] Exception processing {url}: {e}"
+            print(msg)
+            send_telegram_message(msg)
+            yield url, None, None, None
+            continue
+        finally:
+            if body_path == spool_path(url):
+                os.remove(body_path)
+        yield url, digest, count, exceptions
+
+
+HTTP_SCHEME_RE = re.compile(r"^https?://")
+PLAIN_DOMAIN_RE = re.compile(r"^[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$")
 
 
 def normalize_adblock_line(line):
@@ -154,37 +546,885 @@ def normalize_adblock_line(line):
             return domain.lower()
     if line.startswith("|"):
         domain = line.lstrip("|").rstrip("|")
-        domain = re.sub(r"^https?://", "", domain)
+        domain = HTTP_SCHEME_RE.sub("", domain)
         domain = domain.split("^")[0].strip()
         if domain:
             return domain.lower()
     if line and "*" not in line and "/" not in line and "|" not in line and "^" not in line:
-        if re.match(r"^[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$", line):
+        if PLAIN_DOMAIN_RE.match(line):
             return line.lower()
     return None
 
 
-def parse_hosts(text):
-    domains = set()
-    for line in StringIO(text):
+def parse_line(line):
+    """Return the domain blocked by a single hosts/adblock line, or None."""
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    parts = line.split()
+    if len(parts) >= 2 and parts[0] in ["0.0.0.0", "127.0.0.1"]:
+        return parts[1].lower()
+    return normalize_adblock_line(line)
+
+
+def parse_host_lines(lines, domains=None):
+    """Parse an iterable of str lines, adding to (and returning) domains.
+
+    This is the straightforward reference parser; parse_host_bytes() must produce
+    exactly the same domains.
+    """
+    if domains is None:
+        domains = set()
+    for line in lines:
+        candidate = parse_line(line)
+        if candidate:
+            domains.add(candidate)
+    return domains
+
+
+# ASCII separators that str.strip()/split() treat as whitespace but bytes methods don't
+STR_ONLY_WHITESPACE = (b"\x1c", b"\x1d", b"\x1e", b"\x1f")
+HOSTS_IPS = (b"0.0.0.0", b"127.0.0.1")
+DOMAIN_CHARS = b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789.-"
+HASH, BANG, PIPE, ZERO, ONE, AT = b"#!|01@"
+
+
+def needs_slow_path(data):
+    return not data.isascii() or any(sep in data for sep in STR_ONLY_WHITESPACE)
+
+
+def parse_exception(line):
+    """Domain of an adblock "@@||domain^" allow rule (stripped bytes), or None.
+
+    Only whole-domain rules count: path, wildcard and $modifier rules (such as
+    "$script,domain=foo.com") exempt some requests in some contexts, not the
+    domain everywhere.
+    """
+    if line.startswith(b"@@||") and b"$" not in line:
+        domain, _, rest = line[4:].partition(b"^")
+        domain = domain.strip()
+        if domain and not rest.strip(b"|") and b"/" not in domain and b"*" not in domain:
+            return domain.lower()
+    return None
+
+
+def parse_host_bytes(data, domains=None, exceptions=None):
+    """Fast parser for a block of complete lines given as UTF-8 bytes.
+
+    Dispatches on the first byte of each line and works on ASCII bytes without
+    regexes. Lines with non-ASCII bytes or str-only whitespace fall back to
+    parse_line(), so the result is the same as parse_host_lines(), but as
+    UTF-8 bytes: domains are never decoded. If an exceptions set is given,
+    "@@||domain^" allow rules are collected into it.
+    """
+    if domains is None:
+        domains = set()
+    found = set()
+    add = found.add
+    # Decide per block which per-line checks are needed at all; most blocks need neither
+    non_ascii = not data.isascii()
+    separators = any(sep in data for sep in STR_ONLY_WHITESPACE)
+    for line in data.split(b"\n"):
+        if (non_ascii and not line.isascii()) or (separators and needs_slow_path(line)):
+            candidate = parse_line(line.decode("utf-8", "replace"))
+            if candidate:
+                domains.add(candidate.encode("utf-8"))
+            elif exceptions is not None and line.strip().startswith(b"@@"):
+                exception = parse_exception(line.strip())
+                if exception:
+                    exceptions.add(exception)
+            continue
         line = line.strip()
-        if not line or line.startswith("#"):
+        if not line:
             continue
-        parts = line.split()
-        if len(parts) >= 2 and parts[0] in ["0.0.0.0", "127.0.0.1"]:
-            domains.add(parts[1].lower())
+        first = line[0]
+        if first == HASH or first == BANG:
             continue
-        if len(parts) == 1:
-            candidate = normalize_adblock_line(parts[0])
-            if candidate:
-                domains.add(candidate)
+        if first == AT:
+            if exceptions is not None:
+                exception = parse_exception(line)
+                if exception:
+                    exceptions.add(exception)
+            continue
+        if first == PIPE:
+            if line.startswith(b"||"):
+                domain = line[2:].partition(b"^")[0].strip()
+                if domain:
+                    add(domain.lower())
+                    continue
+            domain = line.lstrip(b"|").rstrip(b"|")
+            if domain.startswith(b"http://"):
+                domain = domain[7:]
+            elif domain.startswith(b"https://"):
+                domain = domain[8:]
+            domain = domain.partition(b"^")[0].strip()
+            if domain:
+                add(domain.lower())
+            continue
+        if first == ZERO or first == ONE:
+            parts = line.split(None, 2)
+            if len(parts) >= 2 and parts[0] in HOSTS_IPS:
+                add(parts[1].lower())
                 continue
-        candidate = normalize_adblock_line(line)
-        if candidate:
-            domains.add(candidate)
+        # Plain "example.com" line: only domain characters, ending in a 2+ letter TLD
+        if not line.translate(None, DOMAIN_CHARS):
+            head, _, tld = line.rpartition(b".")
+            if head and len(tld) >= 2 and tld.isalpha():
+                add(line.lower())
+    domains.update(found)
+    return domains
+
+
+def parse_host_chunks(chunks, domains=None, exceptions=None):
+    """Parse an iterable of arbitrary byte chunks, reassembling lines across chunk boundaries."""
+    if domains is None:
+        domains = set()
+    tail = b""
+    for chunk in chunks:
+        data = tail + chunk
+        cut = data.rfind(b"\n")
+        if cut < 0:
+            tail = data
+            continue
+        tail = data[cut + 1:]
+        parse_host_bytes(data[:cut], domains, exceptions)
+    parse_host_bytes(tail, domains, exceptions)
     return domains
 
 
+# ---------------- Parse cache ----------------
+def parse_cache_path(digest, kind="domains"):
+    return os.path.join(PARSE_CACHE_DIR, f"{digest}.v{PARSE_CACHE_VERSION}.{kind}")
+
+
+def load_parsed_blobs(digest):
+    """Load cached (domains, exceptions), sorted and newline-joined, or return None on a miss."""
+    paths = [parse_cache_path(digest), parse_cache_path(digest, "exceptions")]
+    if not all(os.path.isfile(path) for path in paths):
+        return None
+    try:
+        blobs = []
+        for path in paths:
+            with open(path, "rb") as f:
+                blobs.append(f.read())
+    except OSError as e:
+        print(f"[WARNING] Could not read parse cache for {digest}: {e}")
+        return None
+    return tuple(blobs)
+
+
+def load_cached_parse(digest, url=None):
+    """(number of domains, exceptions) of a cached parse or None on a miss. With url, the hit is reported.
+
+    The domains are only counted: the merge reads them from the cache later.
+    """
+    blobs = load_parsed_blobs(digest)
+    if blobs is None:
+        return None
+    count = blob_count(blobs[0])
+    if url:
+        REPORT.parsed(url, 0, 0.0, count, cached=True)
+    return count, domains_from_blob(blobs[1])
+
+
+def domains_to_blob(domains):
+    return b"\n".join(sorted(domains))  # UTF-8 byte order is code point order
+
+
+def domains_from_blob(blob):
+    return set(blob.split(b"\n")) if blob else set()
+
+
+def blob_count(blob):
+    return blob.count(b"\n") + 1 if blob else 0
+
+
+def save_parsed_blob(digest, blob, exceptions_blob, sketch=None):
+    """Cache a parse result. sketch (Sketch.to_bytes()) is built from blob unless given."""
+    if sketch is None:
+        sketch = Sketch.from_domains(blob.split(b"\n") if blob else ()).to_bytes()
+    os.makedirs(PARSE_CACHE_DIR, exist_ok=True)
+    # Domains last: an entry only counts as cached once its .domains file exists
+    for kind, data in (("exceptions", exceptions_blob), ("sketch", sketch), ("domains", blob)):
+        path = parse_cache_path(digest, kind)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+
+def save_parsed_domains(digest, domains, exceptions):
+    sketch = Sketch.from_domains(domains).to_bytes()
+    save_parsed_blob(digest, domains_to_blob(domains), domains_to_blob(exceptions), sketch)
+
+
+def load_sketch(digest):
+    """The cached Sketch of a parsed source, rebuilt from its domains if missing (caches predating sketches)."""
+    path = parse_cache_path(digest, "sketch")
+    try:
+        with open(path, "rb") as f:
+            return Sketch.from_bytes(f.read())
+    except (OSError, ValueError):
+        pass
+    with open(parse_cache_path(digest), "rb") as f:
+        blob = f.read()
+    sketch = Sketch.from_domains(blob.split(b"\n") if blob else ())
+    with open(path + ".tmp", "wb") as f:
+        f.write(sketch.to_bytes())
+    os.replace(path + ".tmp", path)
+    return sketch
+
+
+def parse_hosts_cached(data, url=None):
+    """parse_host_bytes() keyed by a SHA-256 of the body. Returns (digest, number of domains, exceptions).
+
+    With url, the parse is recorded in the run report under that source.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    cached = load_cached_parse(digest, url)
+    if cached is not None:
+        return (digest, *cached)
+    exceptions = set()
+    start = time.perf_counter()
+    domains = parse_host_bytes(data, exceptions=exceptions)
+    if url:
+        REPORT.parsed(url, data.count(b"\n"), time.perf_counter() - start, len(domains))
+    save_parsed_domains(digest, domains, exceptions)
+    return digest, len(domains), exceptions
+
+
+def prune_parse_cache(keep_digests):
+    """Drop cache entries for content no source served this run, and those of older parser versions."""
+    if not os.path.isdir(PARSE_CACHE_DIR):
+        return
+    current = f"v{PARSE_CACHE_VERSION}"
+    for name in os.listdir(PARSE_CACHE_DIR):
+        digest, _, rest = name.partition(".")
+        version, _, kind = rest.rpartition(".")
+        if kind in ("domains", "exceptions", "sketch") and (digest not in keep_digests or version != current):
+            os.remove(os.path.join(PARSE_CACHE_DIR, name))
+
+
+# ---------------- Parallel parse ----------------
+def parse_to_blob(data):
+    """Process-pool worker: parse UTF-8 bytes, return sorted newline-joined (domains, exceptions), the
+    serialized Sketch and stats.
+
+    Returning bytes objects keeps the pickle sent back to the parent small
+    and cheap compared to a set of millions of str.
+    """
+    start = time.perf_counter()
+    exceptions = set()
+    domains = parse_host_bytes(data, exceptions=exceptions)
+    stats = (data.count(b"\n"), time.perf_counter() - start, len(domains))
+    return domains_to_blob(domains), domains_to_blob(exceptions), Sketch.from_domains(domains).to_bytes(), stats
+
+
+def download_and_parse_parallel(urls):
+    """download_and_parse() with parsing farmed out to PARSE_WORKERS processes.
+
+    Downloads are buffered (not streamed) so whole bodies can be shipped to the
+    workers; at most two bodies per worker are queued at any time. Only the
+    small exception lists are turned back into sets here; the domains go to
+    the parse cache as the workers' blobs and are merged from there.
+    """
+    workers = os.cpu_count() if PARSE_WORKERS < 0 else PARSE_WORKERS
+    pending = {}
+
+    def collect(done):
+        for future in done:
+            url, digest = pending.pop(future)
+            try:
+                blob, exceptions_blob, sketch, stats = future.result()
+            except Exception as e:
+                msg = f"[ERROR] Exception processing {url}: {e}"
+                print(msg)
+                send_telegram_message(msg)
+                yield url, None, None, None
+                continue
+            REPORT.parsed(url, *stats)
+            save_parsed_blob(digest, blob, exceptions_blob, sketch)
+            yield url, digest, blob_count(blob), domains_from_blob(exceptions_blob)
+
+    # The workers start on the first submit(), after download_lists() has started the fetcher's
+    # event-loop thread: forking a threaded process can deadlock, so they must not be forked from it
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method)) as pool:
+        for url, data, status in download_lists(urls):
+            if not data and status != 304:
+                yield url, None, None, None
+                continue
+            digest = hashlib.sha256(data).hexdigest()
+            cached = load_cached_parse(digest, url)
+            if cached is not None:
+                yield (url, digest, *cached)
+                continue
+            pending[pool.submit(parse_to_blob, data)] = (url, digest)
+            while len(pending) >= 2 * workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                yield from collect(done)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            yield from collect(done)
+
+
+# ---------------- Allowlist ----------------
+def load_allowlist():
+    """Allowlist from ALLOWLIST_FILE plus HOSTS_BOILERPLATE; source exception rules are added while parsing."""
+    allowlist = Allowlist()
+    for name in HOSTS_BOILERPLATE:
+        allowlist.add_exact(name)
+    if os.path.isfile(ALLOWLIST_FILE):
+        try:
+            allowlist.load(ALLOWLIST_FILE)
+        except (OSError, UnicodeDecodeError) as e:
+            print(f"[WARNING] Could not read allowlist {ALLOWLIST_FILE}: {e}")
+    return allowlist
+
+
+# ---------------- Merge & Output ----------------
+strip_newline = methodcaller("rstrip", b"\n")
+
+
+def iter_merged_sources(sources, counts):
+    """K-way merge of per-source sorted domain lists straight from the parse cache.
+
+    sources is a list of (url, digest). Yields every unique domain once, as bytes
+    in sorted order, holding only one line per source in memory. counts[url] is
+    set to each source's number of entries once the merge is exhausted.
+    """
+    tally = [0] * len(sources)
+    with ExitStack() as stack:
+        streams = []
+        for idx, (_, digest) in enumerate(sources):
+            f = stack.enter_context(open(parse_cache_path(digest), "rb"))
+            streams.append(zip(map(strip_newline, f), repeat(idx)))
+        prev = None
+        for domain, idx in heapq.merge(*streams):
+            tally[idx] += 1
+            if domain != prev:
+                yield domain
+                prev = domain
+    for (url, _), count in zip(sources, tally):
+        counts[url] = count
+
+
+def iter_merged_masks(sources, counts):
+    """iter_merged_sources() yielding (domain, mask): bit i of mask is set if sources[i] lists domain."""
+    tally = [0] * len(sources)
+    with ExitStack() as stack:
+        streams = []
+        for idx, (_, digest) in enumerate(sources):
+            f = stack.enter_context(open(parse_cache_path(digest), "rb"))
+            streams.append(zip(map(strip_newline, f), repeat(idx)))
+        prev, mask = None, 0
+        for domain, idx in heapq.merge(*streams):
+            tally[idx] += 1
+            if domain != prev:
+                if prev is not None:
+                    yield prev, mask
+                prev, mask = domain, 0
+            mask |= 1 << idx
+        if prev is not None:
+            yield prev, mask
+    for (url, _), count in zip(sources, tally):
+        counts[url] = count
+
+
+@contextmanager
+def atomic_write(path):
+    """Open a temp file for binary writing and rename it over path once complete.
+
+    Readers (and the DNS servers pulling the artifact) see either the previous
+    file or the new one, never a truncated one.
+    """
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# ---------------- Output formats ----------------
+DNS_NAME_CHARS = b"abcdefghijklmnopqrstuvwxyz0123456789.-_"
+# In a "\n"-framed batch, these mark an empty label (leading, trailing or doubled dot) or a label starting
+# or ending with a hyphen
+MALFORMED_MARKS = (b"..", b".-", b"-.", b"\n.", b".\n", b"\n-", b"-\n")
+MAX_LABEL = 63
+
+
+def malformed_names(batch):
+    """The domains of batch that resolvers would reject as names.
+
+    That is a character outside DNS_NAME_CHARS, an empty label, a label
+    starting or ending with a hyphen, or a label over MAX_LABEL bytes. Every
+    check is first a single scan over the whole batch, which finds nothing in
+    the common case; only then are the offending domains picked out.
+    """
+    blob = b"\n" + b"\n".join(batch) + b"\n"
+    malformed = set()
+    if blob.translate(None, DNS_NAME_CHARS + b"\n"):
+        malformed.update(domain for domain in batch if domain.translate(None, DNS_NAME_CHARS))
+    for mark in MALFORMED_MARKS:
+        pos = blob.find(mark)
+        while pos >= 0:
+            pos += mark.startswith(b"\n")  # Position inside the domain
+            end = blob.find(b"\n", pos)
+            malformed.add(blob[blob.rfind(b"\n", 0, pos) + 1:end])
+            pos = blob.find(mark, end)
+    if max(map(len, batch)) > MAX_LABEL:
+        malformed.update(
+            domain for domain in batch if len(domain) > MAX_LABEL and max(map(len, domain.split(b"."))) > MAX_LABEL
+        )
+    return malformed
+
+
+class OutputFormat:
+    """One blocklist syntax: every domain is rendered as prefix + domain + suffix.
+
+    Formats read by resolvers that reject malformed names are strict and skip
+    the entries malformed_names() flags. preamble, if given, is a
+    function returning text placed between the comment header and the entries.
+    With comment=None the file has no header at all, and compress=False opts a
+    format out of the pre-compressed variants. covers_subdomains marks syntaxes
+    where an entry also blocks every subdomain, which subdomain compaction may
+    shrink. exception, a (prefix, suffix) pair, renders an entry that lifts
+    the block for one allowlisted name and its subdomains in such a syntax.
+    notes, if given, is a function returning extra header lines; it is
+    called once the body is written. With min_sources > 1 the format only gets
+    the domains listed by at least that many sources.
+    """
+
+    def __init__(self, name, path, prefix, suffix=b"", comment="#", strict=False, preamble=None, compress=True,
+                 covers_subdomains=False, notes=None, min_sources=1, exception=None):
+        self.name = name
+        self.path = path
+        self.prefix = prefix
+        self.suffix = suffix
+        self.comment = comment
+        self.strict = strict
+        self.preamble = preamble
+        self.compress = compress
+        self.covers_subdomains = covers_subdomains
+        self.notes = notes
+        self.min_sources = min_sources
+        self.exception = exception
+        self._separator = suffix + b"\n" + prefix
+
+    def render(self, batch, malformed=()):
+        """Render a batch of domains with a single join. Returns (bytes, entries written)."""
+        if self.strict and malformed:
+            batch = [domain for domain in batch if domain not in malformed]
+        if not batch:  # Possible for strict and consensus formats
+            return b"", 0
+        return self.prefix + self._separator.join(batch) + self.suffix + b"\n", len(batch)
+
+    def render_exceptions(self, names):
+        """Render exception entries for allowlisted names. Returns (bytes, entries written)."""
+        if self.strict and names:
+            malformed = malformed_names(names)
+            names = [name for name in names if name not in malformed]
+        prefix, suffix = self.exception
+        return b"".join(prefix + name + suffix + b"\n" for name in names), len(names)
+
+    def header(self, count, domains_per_source, released_time):
+        c = self.comment
+        if c is None:
+            return ""
+        lines = [
+            f"{c} Title: Wakuvilla/hosts",
+            f"{c} Description: Merged hosts from reputable sources",
+            f"{c} Sources list updated dynamically from: {SOURCE_LIST_URL}",
+            f"{c} Last updated: {released_time}",
+            f"{c} Expires: 6 hours",
+            f"{c} Number of unique domains: {count}",
+        ]
+        if self.notes:
+            lines += [f"{c} {note}" for note in self.notes()]
+        lines += [
+            c,
+            f"{c} Domains per source:",
+        ]
+        lines += [f"{c} {source_url} -> {n} domains" for source_url, n in domains_per_source.items()]
+        lines += [c, "", ""]
+        text = "\n".join(lines)
+        return text + self.preamble() if self.preamble else text
+
+
+def rpz_preamble():
+    serial = int(time.time())
+    return f"$TTL 2h\n@ IN SOA localhost. root.localhost. {serial} 6h 1h 1w 2h\n  IN NS localhost.\n\n"
+
+
+FORMATS = {
+    fmt.name: fmt
+    for fmt in [
+        OutputFormat("hosts", UNIFIED_HOSTS_FILE, b"0.0.0.0 "),
+        OutputFormat("domains", "unified_domains.txt", b""),
+        OutputFormat(
+            "adguard", "unified_adguard.txt", b"||", b"^", comment="!", covers_subdomains=True,
+            exception=(b"@@||", b"^"),
+        ),
+        OutputFormat(
+            "dnsmasq", "unified_dnsmasq.conf", b"address=/", b"/#", strict=True, covers_subdomains=True,
+            exception=(b"server=/", b"/#"),
+        ),
+        OutputFormat(
+            "unbound", "unified_unbound.conf", b'local-zone: "', b'" always_null', strict=True, covers_subdomains=True,
+            exception=(b'local-zone: "', b'" transparent'),
+        ),
+        OutputFormat("rpz", "unified_rpz.zone", b"", b" CNAME .", comment=";", strict=True, preamble=rpz_preamble),
+    ]
+}
+
+
+def consensus_format(fmt, min_sources, agreement):
+    """fmt restricted to domains listed by at least min_sources sources, written next to it as name.minK.ext.
+
+    agreement is the Provenance tallied during the merge that writes it; its
+    per-K sizes go into the header.
+    """
+    root, ext = os.path.splitext(fmt.path)
+
+    def notes():
+        lines = [f"Only domains listed by at least {min_sources} sources", "Domains listed by at least K sources:"]
+        return lines + [f"  K={k}: {count}" for k, count in agreement.at_least().items()]
+
+    return OutputFormat(
+        f"{fmt.name}.min{min_sources}", f"{root}.min{min_sources}{ext}", fmt.prefix, fmt.suffix, fmt.comment,
+        fmt.strict, fmt.preamble, fmt.compress, fmt.covers_subdomains, notes, min_sources, fmt.exception,
+    )
+
+
+def selected_formats():
+    names = [name.strip() for name in OUTPUT_FORMATS.split(",") if name.strip()]
+    unknown = [name for name in names if name not in FORMATS]
+    if unknown:
+        raise ValueError(f"Unknown output format(s): {', '.join(unknown)} (available: {', '.join(FORMATS)})")
+    return [FORMATS[name] for name in names]
+
+
+# ---------------- Compression ----------------
+def gzip_writer(f, level=9):
+    return gzip.GzipFile(fileobj=f, mode="wb", compresslevel=level, mtime=0)
+
+
+def zstd_writer(f):
+    params = zstandard.ZstdCompressionParameters.from_level(
+        ZSTD_LEVEL, window_log=ZSTD_WINDOW_LOG, hash_log=ZSTD_HASH_LOG, chain_log=ZSTD_CHAIN_LOG
+    )
+    return zstandard.ZstdCompressor(compression_params=params).stream_writer(f, closefd=False)
+
+
+COMPRESSORS = {"gz": gzip_writer, "zst": zstd_writer}
+
+
+def selected_compressions():
+    extensions = []
+    for ext in (ext.strip() for ext in OUTPUT_COMPRESSION.split(",")):
+        if not ext:
+            continue
+        if ext not in COMPRESSORS:
+            raise ValueError(f"Unknown output compression: {ext} (available: {', '.join(COMPRESSORS)})")
+        if ext == "zst" and zstandard is None:
+            print("[WARNING] zstandard is not installed, skipping .zst outputs.")
+            continue
+        extensions.append(ext)
+    return extensions
+
+
+def build_subdomain_trie(domains):
+    trie = DomainTrie()
+    for domain in domains:
+        trie.add(domain)
+    return trie
+
+
+def write_outputs(domains, formats, domains_per_source, released_time, compressions=(), trie=None, allowlist=None):
+    """Render sorted, unique domains (bytes) into every format in one pass over them.
+
+    Each format's body is spooled to a temporary file first: with a streaming
+    merge the totals (and the per-source counts) are only known once every
+    domain is out. Compressed variants are produced in the same pass by
+    compressing into their own spools; the header is later compressed as a
+    separate gzip member / zstd frame in front of it, which decompresses to
+    the concatenation. The finished files are then swapped in atomically.
+    With a DomainTrie, formats that cover subdomains skip every domain that has
+    a blocked ancestor. If any format has min_sources > 1, domains yields
+    (domain, number of sources listing it) pairs instead, and those formats
+    get only the domains with enough sources. They are not compacted: a
+    blocked parent need not reach the threshold itself.
+    The allowlist has already been applied to domains, but in a format that
+    covers subdomains a blocked ancestor would still block an allowlisted
+    name. Such names get the format's exception entries after the body.
+    Returns (total unique domains, {format name: entries written}, domains compacted away,
+    {format name: exception entries written}).
+    """
+    counts = dict.fromkeys((fmt.name for fmt in formats), 0)
+    under = allowlist.ancestors() if allowlist else {}
+    exempted = {fmt.name: set() for fmt in formats if fmt.exception and under}
+    exception_counts = dict.fromkeys(exempted, 0)
+    strict = any(fmt.strict for fmt in formats)
+    thresholds = sorted({fmt.min_sources for fmt in formats if fmt.min_sources > 1})
+    total_unique = 0
+    covered = 0
+    targets = [(fmt, ext) for fmt in formats for ext in ["", *(compressions if fmt.compress else ())]]
+    final_paths = [f"{fmt.path}.{ext}" if ext else fmt.path for fmt, ext in targets]
+    spool_paths = [path + ".body.tmp" for path in final_paths]
+    try:
+        with ExitStack() as stack:
+            sinks = {fmt.name: [] for fmt in formats}
+            for (fmt, ext), spool_path in zip(targets, spool_paths):
+                spool = stack.enter_context(open(spool_path, "wb"))
+                if ext:
+                    spool = stack.enter_context(COMPRESSORS[ext](spool))
+                sinks[fmt.name].append(spool)
+            domains = iter(domains)
+            while True:
+                batch = list(islice(domains, WRITE_BATCH))
+                if not batch:
+                    break
+                agreed = {}
+                if thresholds:
+                    pairs = batch
+                    batch = [domain for domain, _ in pairs]
+                    agreed = {k: [domain for domain, n in pairs if n >= k] for k in thresholds}
+                total_unique += len(batch)
+                compacted = batch
+                if trie is not None:
+                    compacted = [domain for domain in batch if not trie.has_blocked_ancestor(domain)]
+                    covered += len(batch) - len(compacted)
+                malformed = malformed_names(batch) if strict else ()
+                for fmt in formats:
+                    if fmt.min_sources > 1:
+                        entries = agreed[fmt.min_sources]
+                    else:
+                        entries = compacted if fmt.covers_subdomains else batch
+                    data, written = fmt.render(entries, malformed)
+                    for sink in sinks[fmt.name]:
+                        sink.write(data)
+                    counts[fmt.name] += written
+                    if fmt.name in exempted:
+                        exempted[fmt.name].update(
+                            name for domain in entries if domain in under and not (fmt.strict and domain in malformed)
+                            for name in under[domain]
+                        )
+            for fmt in formats:
+                if exempted.get(fmt.name):
+                    data, exception_counts[fmt.name] = fmt.render_exceptions(sorted(exempted[fmt.name]))
+                    for sink in sinks[fmt.name]:
+                        sink.write(data)
+        for (fmt, ext), final_path, spool_path in zip(targets, final_paths, spool_paths):
+            header = fmt.header(counts[fmt.name], domains_per_source, released_time).encode("utf-8")
+            with atomic_write(final_path) as f, open(spool_path, "rb") as body:
+                if ext:
+                    with COMPRESSORS[ext](f) as compressed:
+                        compressed.write(header)
+                else:
+                    f.write(header)
+                shutil.copyfileobj(body, f, READ_CHUNK_SIZE)
+    finally:
+        for spool_path in spool_paths:
+            if os.path.exists(spool_path):
+                os.remove(spool_path)
+    return total_unique, counts, covered, exception_counts
+
+
+# ---------------- Delta ----------------
+def iter_sorted_diff(old, new):
+    """Streaming diff of two sorted, duplicate-free iterables. Yields ("-"/"+", item)."""
+    old, new = iter(old), iter(new)
+    o, n = next(old, None), next(new, None)
+    while o is not None or n is not None:
+        if n is None or (o is not None and o < n):
+            yield "-", o
+            o = next(old, None)
+        elif o is None or n < o:
+            yield "+", n
+            n = next(new, None)
+        else:
+            o, n = next(old, None), next(new, None)
+
+
+def load_manifest():
+    if os.path.isfile(MANIFEST_FILE):
+        with open(MANIFEST_FILE, "r", encoding="utf-8") as f:
+            try:
+                return json.load(f)
+            except json.JSONDecodeError:
+                return {}
+    return {}
+
+
+def save_manifest(manifest):
+    with atomic_write(MANIFEST_FILE) as f:
+        f.write(json.dumps(manifest, indent=2).encode("utf-8"))
+
+
+def write_delta(new_snapshot, released_time, total_unique, extra=None):
+    """Diff the new build against BUILD_SNAPSHOT_FILE and publish DELTA_FILE plus MANIFEST_FILE.
+
+    Both snapshots are sorted, newline-terminated domain lists, so the delta is
+    a single streaming merge over the two files. Lines are "+domain" for
+    additions and "-domain" for removals. Resolvers whose current list hashes to
+    previous_hash can apply the delta instead of reloading the full list; with
+    no previous build the delta is every domain as an addition. Finally
+    new_snapshot becomes the base for the next run. extra is merged into the
+    manifest.
+    """
+    previous = load_manifest()
+    has_previous = os.path.isfile(BUILD_SNAPSHOT_FILE)
+    added = removed = 0
+    with ExitStack() as stack:
+        old = stack.enter_context(open(BUILD_SNAPSHOT_FILE, "rb")) if has_previous else ()
+        new = stack.enter_context(open(new_snapshot, "rb"))
+        delta = stack.enter_context(atomic_write(DELTA_FILE))
+        for sign, domain in iter_sorted_diff(old, new):
+            if sign == "+":
+                delta.write(b"+" + domain)
+                added += 1
+            else:
+                delta.write(b"-" + domain)
+                removed += 1
+    manifest = {
+        "version": previous.get("version", 0) + 1,
+        "generated": released_time,
+        "count": total_unique,
+        "hash": file_digest(new_snapshot),
+        "previous_hash": file_digest(BUILD_SNAPSHOT_FILE) if has_previous else None,
+        "delta": DELTA_FILE,
+        "delta_hash": file_digest(DELTA_FILE),
+        "added": added,
+        "removed": removed,
+        **(extra or {}),
+    }
+    save_manifest(manifest)
+    os.replace(new_snapshot, BUILD_SNAPSHOT_FILE)
+    return manifest
+
+
+# ---------------- No-op detection ----------------
+def output_paths(formats, compressions):
+    return [path for fmt in formats for path in [fmt.path, *(f"{fmt.path}.{ext}" for ext in compressions if fmt.compress)]]
+
+
+def build_inputs(urls, parsed_sources, formats, compressions):
+    """Everything a build's output depends on, as hashes: same inputs, same artifacts.
+
+    sources maps each successfully parsed source to its content hash, so a
+    source failing twice in a row does not force a rebuild. The config hash
+    covers the output settings, the allowlist file, this script and every
+    module it builds with.
+    """
+    config = hashlib.sha256()
+    for part in (",".join(fmt.name for fmt in formats), ",".join(compressions), str(ZSTD_LEVEL), str(COMPACT_SUBDOMAINS)):
+        config.update(part.encode("utf-8") + b"\0")
+    modules = [
+        sys.modules[obj.__module__].__file__ for obj in (Allowlist, DomainSet, DomainTrie, Provenance, Sketch, fetch_all)
+    ]
+    for path in (os.path.abspath(__file__), *modules, ALLOWLIST_FILE):
+        if os.path.isfile(path):
+            config.update(file_digest(path).encode("ascii"))
+    return {
+        "sources": dict(parsed_sources),
+        "sources_hash": hashlib.sha256("\n".join(urls).encode("utf-8")).hexdigest(),
+        "config_hash": config.hexdigest(),
+    }
+
+
+def output_hashes(paths):
+    return {path: {"sha256": file_digest(path), "size": os.path.getsize(path)} for path in paths}
+
+
+def is_unchanged(previous, inputs, paths):
+    """True if the previous build had the same inputs and its artifacts are still in place, unmodified."""
+    if not previous or any(previous.get(key) != value for key, value in inputs.items()):
+        return False
+    outputs = previous.get("outputs", {})
+    if set(outputs) != set(paths) or not os.path.isfile(BUILD_SNAPSHOT_FILE):
+        return False
+    # Sizes first: a cheap check that catches most damage before hashing anything
+    if not all(os.path.isfile(path) and os.path.getsize(path) == outputs[path]["size"] for path in paths):
+        return False
+    return all(file_digest(path) == outputs[path]["sha256"] for path in paths)
+
+
+# ---------------- Provenance ----------------
+def save_provenance(provenance, released_time):
+    with atomic_write(PROVENANCE_FILE) as f:
+        f.write(json.dumps({"generated": released_time, **provenance.summary()}, indent=2).encode("utf-8"))
+
+
+def print_provenance(provenance, domains_per_source):
+    stats = dict(zip(provenance.sources, zip(provenance.entries(), provenance.unique())))
+    for url, count in domains_per_source.items():
+        if url in stats:
+            print(f"  {url} -> {stats[url][0]} domains, {stats[url][1]} only from this source")
+        else:
+            print(f"  {url} -> {count} domains")
+    redundant = [url for url, unique in zip(provenance.sources, provenance.unique()) if not unique]
+    if redundant:
+        print(f"{len(redundant)} source(s) add no domain of their own:")
+        for url in redundant:
+            print(f"  {url}")
+
+
+# ---------------- Overlap estimates ----------------
+def estimate_overlap(sketches):
+    """Estimated sizes, pairwise Jaccard similarity and union size from (url, Sketch) pairs.
+
+    For a pair, |A & B| = J * |A | B| and |A | B| = (|A| + |B|) / (1 + J), so
+    with the exact per-source sizes the Jaccard estimate also yields how much
+    of either source the other one already covers.
+    """
+    n = len(sketches)
+    jaccard = [[1.0] * n for _ in range(n)]
+    redundant = []
+    for a in range(n):
+        for b in range(a + 1, n):
+            j = sketches[a][1].jaccard(sketches[b][1])
+            jaccard[a][b] = jaccard[b][a] = round(j, 4)
+            common = j * (sketches[a][1].count + sketches[b][1].count) / (1 + j)
+            for inner, outer in ((a, b), (b, a)):
+                size = sketches[inner][1].count
+                if size and common / size >= REDUNDANT_CONTAINMENT:
+                    redundant.append({
+                        "source": sketches[inner][0],
+                        "covered_by": sketches[outer][0],
+                        "containment": round(min(common / size, 1.0), 4),
+                    })
+    union = None
+    for _, sketch in sketches:
+        union = sketch if union is None else union.union(sketch)
+    return {
+        "sources": [
+            {"url": url, "domains": sketch.count, "estimated": sketch.cardinality()} for url, sketch in sketches
+        ],
+        "union_estimate": union.cardinality() if union is not None else 0,
+        "jaccard": jaccard,
+        "redundant": sorted(redundant, key=lambda pair: -pair["containment"]),
+    }
+
+
+def save_overlap(parsed_sources, released_time):
+    overlap = estimate_overlap([(url, load_sketch(digest)) for url, digest in parsed_sources])
+    with atomic_write(OVERLAP_FILE) as f:
+        f.write(json.dumps({"generated": released_time, **overlap}, indent=2).encode("utf-8"))
+    return overlap
+
+
+def print_overlap(overlap):
+    total = sum(source["domains"] for source in overlap["sources"])
+    print(f"Sources list {total} domains in total, an estimated {overlap['union_estimate']} distinct.")
+    for pair in overlap["redundant"]:
+        print(f"  ~{pair['containment']:.0%} of {pair['source']} is also in {pair['covered_by']}")
+
+
 # ---------------- History ----------------
 def log_count_to_history(date_str, count):
     history = []
@@ -224,66 +1464,134 @@ def log_count_to_history(date_str, count):
 # ---------------- Main ----------------
 def main():
     try:
-        update_sources_file()
+        with REPORT.stage("update_sources"):
+            update_sources_file()
 
         urls = load_urls(SOURCES_FILE)
-        all_domains = set()
+        formats = selected_formats()
+        compressions = selected_compressions()
+        # Consensus counts need the per-source k-way merge
+        all_domains = DomainSet() if MERGE_STRATEGY == "set" and MIN_SOURCES <= 1 else None
         domains_per_source = {}
+        parsed_sources = []
+        allowlist = load_allowlist()
 
         error_tracker = load_error_tracker()
 
-        with ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
-            futures = {executor.submit(download_list, url): url for url in urls}
-
-            for future in as_completed(futures):
-                url = futures[future]
-                try:
-                    _, text = future.result()
-                    if text:
-                        domains = parse_hosts(text)
-                        domains_per_source[url] = len(domains)
-                        all_domains.update(domains)
-                        record_result(url, True, error_tracker)
-                    else:
-                        domains_per_source[url] = 0
-                        record_result(url, False, error_tracker)
-                except Exception as e:
-                    msg = f"[ERROR] Exception processing {url}: {e}"
-                    print(msg)
-                    send_telegram_message(msg)
+        with REPORT.stage("download_parse"):
+            for url, digest, count, exceptions in download_and_parse(urls):
+                if count is not None:
+                    parsed_sources.append((url, digest))
+                    domains_per_source[url] = count
+                    for domain in exceptions:
+                        allowlist.add_suffix(domain)
+                    if all_domains is not None:
+                        # Already sorted in the parse cache: merged as one run, no per-domain objects
+                        with open(parse_cache_path(digest), "rb") as f:
+                            all_domains.merge_sorted_blob(f.read())
+                    record_result(url, True, error_tracker)
+                else:
                     domains_per_source[url] = 0
                     record_result(url, False, error_tracker)
 
         save_error_tracker(error_tracker)
+        # Provenance bits follow the sources file, not download completion order
+        order = {url: idx for idx, url in enumerate(urls)}
+        parsed_sources.sort(key=lambda source: order[source[0]])
 
-        total_unique = len(all_domains)
         released_time = datetime.utcnow().strftime("%Y-%m-%d %H:%M UTC")
         date_str = datetime.utcnow().strftime("%Y-%m-%d")
 
+        # Only the k-way merge knows which source each domain came from
+        provenance = Provenance(url for url, _ in parsed_sources) if all_domains is None else None
+        consensus_formats = []
+        if MIN_SOURCES > 1:
+            consensus_formats = [consensus_format(fmt, MIN_SOURCES, provenance) for fmt in formats]
+        paths = output_paths(formats + consensus_formats, compressions)
+        inputs = build_inputs(urls, parsed_sources, formats + consensus_formats, compressions)
+        previous = load_manifest()
+        if is_unchanged(previous, inputs, paths):
+            # Nothing upstream changed: keep every artifact, just record that we checked
+            previous["checked"] = released_time
+            save_manifest(previous)
+            prune_parse_cache({digest for _, digest in parsed_sources})
+            print(f"No source changed since build {previous['version']}; keeping its {previous['count']} domains.")
+            log_count_to_history(date_str, previous["count"])
+            publish_run_report(previous["count"])
+            return
+
+        if all_domains is not None:
+            with REPORT.stage("sort"):
+                len(all_domains)  # Folds the pending runs into one sorted run
+
+        def merged_domains(provenance=None, index=None, with_sources=False):
+            allowlist.hits = 0
+            if provenance is not None:
+                pairs = iter_merged_masks(parsed_sources, domains_per_source)
+                if allowlist:
+                    pairs = filterfalse(lambda pair: allowlist.allows(pair[0]), pairs)
+                return provenance.track(pairs, index, with_sources)
+            if all_domains is not None:
+                domains = map(strip_newline, all_domains.iter_bytes())
+            else:
+                domains = iter_merged_sources(parsed_sources, domains_per_source)
+            return filterfalse(allowlist.allows, domains) if allowlist else domains
+
+        # Compaction needs every domain in the trie before the output pass, so it merges twice
+        trie = None
+        if COMPACT_SUBDOMAINS:
+            with REPORT.stage("subdomain_trie"):
+                trie = build_subdomain_trie(merged_domains())
+        snapshot = OutputFormat("snapshot", BUILD_SNAPSHOT_FILE + ".new", b"", comment=None, compress=False)
+        # The k-way merge is consumed by the writer, so merging and writing are one stage
+        with REPORT.stage("merge_write"), ExitStack() as stack:
+            index = None
+            if provenance is not None and PROVENANCE_INDEX_FILE:
+                f = stack.enter_context(atomic_write(PROVENANCE_INDEX_FILE))
+                index = stack.enter_context(gzip_writer(f, INDEX_GZIP_LEVEL))
+                index.write(provenance.index_header())
+            total_unique, format_counts, covered, exception_counts = write_outputs(
+                merged_domains(provenance, index, bool(consensus_formats)), formats + consensus_formats + [snapshot],
+                domains_per_source, released_time, compressions, trie, allowlist
+            )
+        if provenance is not None:
+            save_provenance(provenance, released_time)
+        with REPORT.stage("overlap"):
+            overlap = save_overlap(parsed_sources, released_time)
+        del trie
+        prune_parse_cache({digest for _, digest in parsed_sources})
+        with REPORT.stage("delta"):
+            extra = {**inputs, "outputs": output_hashes(paths), "checked": released_time}
+            manifest = write_delta(snapshot.path, released_time, total_unique, extra)
+        print(f"Build {manifest['version']}: +{manifest['added']} / -{manifest['removed']} domains since last build.")
+
         print("Entries per source:")
-        for source_url, count in domains_per_source.items():
-            print(f"  {source_url} -> {count} domains")
-
-        with open("unified_hosts.txt", "w", encoding="utf-8") as f:
-            f.write("# Title: Wakuvilla/hosts\n")
-            f.write("# Description: Merged hosts from reputable sources\n")
-            f.write(f"# Sources list updated dynamically from: {SOURCE_LIST_URL}\n")
-            f.write(f"# Last updated: {released_time}\n")
-            f.write("# Expires: 6 hours\n")
-            f.write(f"# Number of unique domains: {total_unique}\n")
-            f.write("#\n")
-            f.write("# Domains per source:\n")
+        if provenance is not None:
+            print_provenance(provenance, domains_per_source)
+        else:
             for source_url, count in domains_per_source.items():
-                f.write(f"# {source_url} -> {count} domains\n")
-            f.write("#\n\n")
-            for domain in sorted(all_domains):
-                f.write(f"0.0.0.0 {domain}\n")
+                print(f"  {source_url} -> {count} domains")
 
-        print(f"File 'unified_hosts.txt' generated with {total_unique} domains.")
+        print_overlap(overlap)
+        print(f"Merged {total_unique} unique domains.")
+        if allowlist:
+            print(f"Allowlist ({len(allowlist)} rules) exempted {allowlist.hits} domains.")
+        if COMPACT_SUBDOMAINS:
+            print(f"Subdomain compaction removed {covered} domains already covered by a blocked parent.")
+        for fmt in formats:
+            print(f"File '{fmt.path}' generated with {format_counts[fmt.name]} entries.")
+        for name, count in exception_counts.items():
+            if count:
+                print(f"  {name}: {count} allowlisted names under a blocked domain got an exception entry.")
+        for fmt in consensus_formats:
+            print(f"File '{fmt.path}' generated with {format_counts[fmt.name]} entries "
+                  f"listed by at least {MIN_SOURCES} sources.")
 
         # Log count to CSV history (last 30 days only)
         log_count_to_history(date_str, total_unique)
 
+        publish_run_report(total_unique)
+
     except Exception:
         error_details = "".join(traceback.format_exception(*sys.exc_info()))
         send_telegram_message(f"Github action blocklist error\n⚠️ *Script Error*\n```\n{error_details}\n```")
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""Which sources list each merged domain.
+
+Sources are numbered in a fixed order and every domain gets one integer
+bitmask, bit i set when sources[i] lists it. The masks come out of the k-way
+merge for free (one OR per source entry), so no per-domain lists are kept.
+Only a histogram of the masks stays in memory: a few thousand distinct
+masks describe millions of domains, and every per-source figure (entries,
+unique contribution, pairwise overlap, how many sources agree on a domain)
+follows from it. The full domain -> mask index can be streamed to a file.
+"""
+from itertools import combinations
+
+INDEX_BATCH = 1 << 16  # Index lines joined into a single write() call
+
+
+def bits(mask):
+    """Indexes of the set bits of mask, lowest first."""
+    idx = 0
+    while mask:
+        if mask & 1:
+            yield idx
+        mask >>= 1
+        idx += 1
+
+
+class Provenance:
+    def __init__(self, sources):
+        self.sources = list(sources)  # Bit i stands for sources[i]
+        self.masks = {}  # Mask -> number of domains listed by exactly that set of sources
+
+    def track(self, pairs, index=None, with_sources=False):
+        """Tally (domain, mask) pairs and yield the domains.
+
+        With with_sources, (domain, number of sources listing it) pairs are
+        yielded instead. With index (a binary file), "domain<TAB>mask in hex"
+        lines are written to it along the way.
+        """
+        masks = self.masks
+        batch = []
+        for domain, mask in pairs:
+            masks[mask] = masks.get(mask, 0) + 1
+            if index is not None:
+                batch.append(b"%s\t%x\n" % (domain, mask))
+                if len(batch) >= INDEX_BATCH:
+                    index.write(b"".join(batch))
+                    batch = []
+            yield (domain, bin(mask).count("1")) if with_sources else domain
+        if batch:
+            index.write(b"".join(batch))
+
+    def index_header(self):
+        return "".join(f"# bit {idx}: {url}\n" for idx, url in enumerate(self.sources)).encode("utf-8")
+
+    def entries(self):
+        """Domains per source (after the allowlist)."""
+        totals = [0] * len(self.sources)
+        for mask, count in self.masks.items():
+            for idx in bits(mask):
+                totals[idx] += count
+        return totals
+
+    def unique(self):
+        """Domains no other source lists, per source."""
+        return [self.masks.get(1 << idx, 0) for idx in range(len(self.sources))]
+
+    def agreement(self):
+        """{k: number of domains listed by exactly k sources}."""
+        histogram = {}
+        for mask, count in self.masks.items():
+            k = bin(mask).count("1")
+            histogram[k] = histogram.get(k, 0) + count
+        return dict(sorted(histogram.items()))
+
+    def at_least(self):
+        """{k: number of domains listed by k or more sources}."""
+        cumulative, total = {}, 0
+        for k, count in sorted(self.agreement().items(), reverse=True):
+            total += count
+            cumulative[k] = total
+        return dict(sorted(cumulative.items()))
+
+    def overlaps(self):
+        """Symmetric matrix of domains listed by both sources; the diagonal holds entries()."""
+        n = len(self.sources)
+        matrix = [[0] * n for _ in range(n)]
+        for mask, count in self.masks.items():
+            members = list(bits(mask))
+            for idx in members:
+                matrix[idx][idx] += count
+            for a, b in combinations(members, 2):
+                matrix[a][b] += count
+                matrix[b][a] += count
+        return matrix
+
+    def summary(self):
+        entries, unique = self.entries(), self.unique()
+        return {
+            "domains": sum(self.masks.values()),
+            "single_source": sum(unique),
+            "sources": [
+                {"bit": idx, "url": url, "entries": entries[idx], "unique": unique[idx]}
+                for idx, url in enumerate(self.sources)
+            ],
+            "sources_per_domain": self.agreement(),
+            "overlaps": self.overlaps(),
+        }
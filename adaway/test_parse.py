@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Differential test: the bytes parser must agree with the reference str parser.
+
+parse_host_bytes() and parse_host_chunks() are checked against
+parse_host_lines() on seeded random documents mixing hosts and adblock
+syntax, comments, CRLF line ends, non-ASCII lines, the \\x1c-\\x1f separators
+(whitespace to str but not to bytes) and arbitrary chunk boundaries, including
+ones inside a multi-byte UTF-8 character.
+
+    python3 -m unittest test_parse
+    PARSE_FUZZ_CASES=100000 python3 -m unittest test_parse
+"""
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import main  # noqa: E402
+
+PARSE_FUZZ_CASES = int(os.getenv("PARSE_FUZZ_CASES", "2000"))  # Random documents per test
+PARSE_FUZZ_SEED = int(os.getenv("PARSE_FUZZ_SEED", "1"))
+
+PREFIXES = [
+    "", "", "0.0.0.0 ", "127.0.0.1 ", "0.0.0.0\t", "127.0.0.1  ", "::1 ", "0.0.0.1 ", "||", "|", "|http://",
+    "|https://", "@@||", "#", "# ", "!", " ", "\t", "0.0.0.0", "1", "0",
+]
+DOMAINS = [
+    "example.com", "Ads.Example.COM", "a.b-c.io", "x1.de", "tracker.net", "münchen.de", "ДОМЕН.рф", "localhost",
+    "foo..bar.com", ".lead.com", "a", "ab.c", "ab.c1", "plain.org", "under_score.net", "-", "0.0.0.0",
+]
+SUFFIXES = [
+    "", "", "", "^", "^$third-party", "^|", "|", "/path/*.gif", "*", " # comment", "###banner", " extra.com",
+    "\r", " \r", "\t", "$script", "^\r",
+]
+NOISE = ["\x1c", "\x1d", "\x1e", "\x1f", "\xa0", " ", "\x0b", "\x0c", " ", "é", "\r"]
+
+
+def random_line(rng):
+    line = rng.choice(PREFIXES) + rng.choice(DOMAINS) + rng.choice(SUFFIXES)
+    for _ in range(rng.choice([0, 0, 0, 1, 2])):
+        at = rng.randint(0, len(line))
+        line = line[:at] + rng.choice(NOISE) + line[at:]
+    return line
+
+
+def random_document(rng):
+    lines = [random_line(rng) for _ in range(rng.randint(0, 40))]
+    text = ("\r\n" if rng.random() < 0.3 else "\n").join(lines)
+    if rng.random() < 0.5:
+        text += "\n"
+    return text
+
+
+def random_chunks(rng, data):
+    cuts = sorted(rng.sample(range(len(data) + 1), min(len(data) + 1, rng.randint(0, 8))))
+    return [data[start:end] for start, end in zip([0, *cuts], [*cuts, len(data)])]
+
+
+def reference(text):
+    return {domain.encode("utf-8") for domain in main.parse_host_lines(text.split("\n"))}
+
+
+class ParseDifferentialTest(unittest.TestCase):
+    def test_bytes_matches_lines(self):
+        rng = random.Random(PARSE_FUZZ_SEED)
+        for _ in range(PARSE_FUZZ_CASES):
+            text = random_document(rng)
+            with self.subTest(text=text):
+                self.assertEqual(main.parse_host_bytes(text.encode("utf-8")), reference(text))
+
+    def test_chunks_match_lines(self):
+        rng = random.Random(PARSE_FUZZ_SEED + 1)
+        for _ in range(PARSE_FUZZ_CASES):
+            text = random_document(rng)
+            chunks = random_chunks(rng, text.encode("utf-8"))
+            with self.subTest(text=text, chunks=chunks):
+                self.assertEqual(main.parse_host_chunks(chunks), reference(text))
+
+    def test_block_level_dispatch(self):
+        # One non-ASCII or separator line switches the whole block to per-line checks
+        text = "0.0.0.0 plain.com\nmünchen.de\n||ads.example.com^\n0.0.0.0\x1ctracker.net\nx1.de\n"
+        self.assertEqual(main.parse_host_bytes(text.encode("utf-8")), reference(text))
+
+    def test_exception_rules(self):
+        # Only whole-domain "@@||domain^" rules become allowlist entries
+        text = (
+            "@@||keep.example.com^\n@@||pipe.example.com^|\n@@||scoped.example.com^$script,domain=foo.com\n"
+            "@@||doc.example.com^$document\n@@||path.example.com/ads^\n@@||*.wild.example.com^\n"
+        )
+        exceptions = set()
+        main.parse_host_bytes(text.encode("utf-8"), exceptions=exceptions)
+        self.assertEqual(exceptions, {b"keep.example.com", b"pipe.example.com"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""Shared asyncio download engine for adaway and skynet.
+
+One HTTP/2-capable client is shared by every download, so sources that live on
+the same host (v.firebog.net, raw.githubusercontent.com, iplists.firehol.org)
+reuse pooled keep-alive connections. Concurrency is capped globally and per
+host, and transient failures are retried with exponential backoff.
+
+Every fetch can be recorded into a snapshot directory (FETCH_RECORD_DIR) and
+later replayed from it (FETCH_REPLAY_DIR) without touching the network: the
+replay serves the recorded bodies and headers through the same interface, in
+input order and without any waiting.
+"""
+import asyncio
+import hashlib
+import importlib.util
+import json
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from urllib.parse import urlsplit
+
+import httpx
+
+MAX_CONNECTIONS = int(os.getenv("FETCH_MAX_CONNECTIONS", "16"))  # Global concurrency limit
+MAX_PER_HOST = int(os.getenv("FETCH_MAX_PER_HOST", "4"))  # Concurrent requests to one host
+RETRIES = int(os.getenv("FETCH_RETRIES", "3"))  # Extra attempts after the first failure
+BACKOFF = float(os.getenv("FETCH_BACKOFF", "1.0"))  # Base delay in seconds, doubled per attempt
+TIMEOUT = 20
+RECORD_DIR = os.getenv("FETCH_RECORD_DIR")  # Save every fetched body and its headers here
+REPLAY_DIR = os.getenv("FETCH_REPLAY_DIR")  # Serve fetches from a recorded snapshot, offline
+SNAPSHOT_INDEX = "index.json"
+REPLAY_CHUNK_SIZE = 1 << 20  # Bytes fed to a sink per chunk on replay
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Transport errors that come from the request itself (a malformed URL), which no retry can fix
+PERMANENT_ERRORS = (httpx.UnsupportedProtocol, httpx.LocalProtocolError, httpx.InvalidURL)
+HTTP2 = importlib.util.find_spec("h2") is not None  # httpx only speaks HTTP/2 with h2 installed
+
+
+@dataclass
+class FetchResult:
+    url: str
+    status: int = None
+    content: bytes = b""
+    headers: dict = field(default_factory=dict)
+    error: str = None
+    value: object = None  # Whatever the sink returned, when streaming
+    # Seconds for elapsed/queued/connect/ttfb of the last attempt, plus bytes and attempts
+    timing: dict = field(default_factory=dict)
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def text(self):
+        # Lists are UTF-8 (mostly ASCII) in practice; no charset sniffing over multi-MB bodies
+        return self.content.decode("utf-8", "replace")
+
+
+async def _read_response(url, resp, sink_for):
+    if sink_for is None:
+        await resp.aread()
+        return FetchResult(url, resp.status_code, resp.content, resp.headers)
+    sink = sink_for(url, resp.headers)
+    try:
+        async for chunk in resp.aiter_bytes():
+            sink.feed(chunk)
+    except BaseException:
+        sink.abort()
+        raise
+    return FetchResult(url, resp.status_code, headers=resp.headers, value=sink.close())
+
+
+def _connect_seconds(events):
+    """TCP connect (DNS included) plus TLS handshake time from httpcore trace events; 0 on a reused connection."""
+    seconds = 0.0
+    for step in ("connection.connect_tcp", "connection.start_tls"):
+        if f"{step}.complete" in events and f"{step}.started" in events:
+            seconds += events[f"{step}.complete"] - events[f"{step}.started"]
+    return seconds
+
+
+async def _fetch_one(client, url, headers, sink_for, global_limit, host_limit, retries, backoff):
+    timing = {}
+    start = time.perf_counter()
+    result = await _fetch_attempts(client, url, headers, sink_for, global_limit, host_limit, retries, backoff, timing)
+    timing["elapsed"] = time.perf_counter() - start
+    result.timing = timing
+    return result
+
+
+async def _fetch_attempts(client, url, headers, sink_for, global_limit, host_limit, retries, backoff, timing):
+    attempt = 0
+    events = {}
+
+    async def trace(name, info):
+        events[name] = time.perf_counter()
+
+    while True:
+        timing["attempts"] = attempt + 1
+        queued = time.perf_counter()
+        try:
+            # Host slot first: waiting on a busy host must not hold a global slot other hosts could use
+            async with host_limit, global_limit:
+                events.clear()
+                sent = time.perf_counter()
+                timing["queued"] = sent - queued
+                async with client.stream("GET", url, headers=headers, extensions={"trace": trace}) as resp:
+                    timing["ttfb"] = time.perf_counter() - sent
+                    timing["connect"] = _connect_seconds(events)
+                    if resp.status_code in RETRY_STATUSES and attempt < retries:
+                        raise httpx.HTTPStatusError(f"HTTP {resp.status_code}", request=resp.request, response=resp)
+                    if resp.status_code == 304:
+                        return FetchResult(url, 304, b"", resp.headers)
+                    resp.raise_for_status()
+                    result = await _read_response(url, resp, sink_for)
+                    timing["bytes"] = resp.num_bytes_downloaded
+                    return result
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            status = e.response.status_code if isinstance(e, httpx.HTTPStatusError) else None
+            retryable = status in RETRY_STATUSES if status is not None else not isinstance(e, PERMANENT_ERRORS)
+            if not retryable or attempt >= retries:
+                return FetchResult(url, status, error=str(e) or type(e).__name__)
+            delay = backoff * (2 ** attempt) * (1 + random.random() / 2)
+            print(f"[WARNING] {url} failed ({e}), retrying in {delay:.1f}s ({attempt + 1}/{retries})")
+            attempt += 1
+            await asyncio.sleep(delay)
+        except Exception as e:
+            return FetchResult(url, error=str(e) or type(e).__name__)
+
+
+# ---------------- Snapshots ----------------
+def _snapshot_body_name(url):
+    return hashlib.sha256(url.encode("utf-8")).hexdigest() + ".body"
+
+
+def _load_snapshot_index(directory):
+    path = os.path.join(directory, SNAPSHOT_INDEX)
+    if not os.path.isfile(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class _Recorder:
+    """Collects fetched bodies and response metadata into a snapshot directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.entries = {}
+        self.streamed = set()  # URLs whose body a _RecordingSink already wrote
+        os.makedirs(directory, exist_ok=True)
+
+    def body_path(self, url):
+        return os.path.join(self.directory, _snapshot_body_name(url))
+
+    def wrap(self, sink_for):
+        def recording_sink_for(url, headers):
+            return _RecordingSink(self, url, sink_for(url, headers))
+        return recording_sink_for
+
+    def add(self, result):
+        entry = {"status": result.status, "headers": dict(result.headers), "error": result.error, "body": None}
+        if result.ok:
+            if result.url not in self.streamed:
+                with open(self.body_path(result.url), "wb") as f:
+                    f.write(result.content)
+            entry["body"] = _snapshot_body_name(result.url)
+        self.entries[result.url] = entry
+
+    def save(self):
+        # Merge with what earlier fetch_all() calls of the same run recorded
+        index = _load_snapshot_index(self.directory)
+        index.update(self.entries)
+        path = os.path.join(self.directory, SNAPSHOT_INDEX)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(index, f, indent=2)
+        os.replace(path + ".tmp", path)
+
+
+class _RecordingSink:
+    """Tees the chunks of a streamed response into the snapshot."""
+
+    def __init__(self, recorder, url, inner):
+        self.recorder = recorder
+        self.url = url
+        self.inner = inner
+        self.path = recorder.body_path(url)
+        self.file = open(self.path + ".tmp", "wb")
+
+    def feed(self, chunk):
+        self.file.write(chunk)
+        self.inner.feed(chunk)
+
+    def close(self):
+        self.file.close()
+        os.replace(self.path + ".tmp", self.path)
+        self.recorder.streamed.add(self.url)
+        return self.inner.close()
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.path + ".tmp")
+        self.inner.abort()
+
+
+def _replay(urls, sink_for, directory):
+    index = _load_snapshot_index(directory)
+    for url in urls:
+        print(f"Replaying {url}")
+        entry = index.get(url)
+        if entry is None:
+            yield FetchResult(url, error=f"not in snapshot {directory}")
+            continue
+        headers = httpx.Headers(entry["headers"])
+        if entry["error"] is not None:
+            yield FetchResult(url, entry["status"], headers=headers, error=entry["error"])
+            continue
+        path = os.path.join(directory, entry["body"])
+        start = time.perf_counter()
+        try:
+            with open(path, "rb") as f:
+                if sink_for is None:
+                    content = f.read()
+                    timing = {"elapsed": time.perf_counter() - start, "bytes": len(content)}
+                    yield FetchResult(url, entry["status"], content, headers, timing=timing)
+                    continue
+                sink = sink_for(url, headers)
+                try:
+                    while chunk := f.read(REPLAY_CHUNK_SIZE):
+                        sink.feed(chunk)
+                except BaseException:
+                    sink.abort()
+                    raise
+        except Exception as e:
+            yield FetchResult(url, error=str(e) or type(e).__name__)
+            continue
+        value = sink.close()
+        timing = {"elapsed": time.perf_counter() - start, "bytes": os.path.getsize(path)}
+        yield FetchResult(url, entry["status"], headers=headers, value=value, timing=timing)
+
+
+# ---------------- Fetching ----------------
+async def _fetch_into(results, urls, headers_for, sink_for, max_connections, max_per_host, retries, backoff):
+    limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+    global_limit = asyncio.Semaphore(max_connections)
+    host_limits = {}
+
+    async def worker(client, url):
+        # Every URL must put exactly one result on the queue, or fetch_all() waits forever
+        try:
+            host = urlsplit(url).hostname or ""
+            host_limit = host_limits.setdefault(host, asyncio.Semaphore(max_per_host))
+            headers = headers_for(url) if headers_for else None
+            print(f"Fetching {url}")
+            result = await _fetch_one(client, url, headers, sink_for, global_limit, host_limit, retries, backoff)
+        except Exception as e:
+            result = FetchResult(url, error=str(e) or type(e).__name__)
+        await results.put(result)
+
+    async with httpx.AsyncClient(http2=HTTP2, limits=limits, timeout=TIMEOUT, follow_redirects=True) as client:
+        await asyncio.gather(*(worker(client, url) for url in urls))
+
+
+def fetch_all(urls, headers_for=None, sink_for=None, max_connections=MAX_CONNECTIONS,
+              max_per_host=MAX_PER_HOST, retries=RETRIES, backoff=BACKOFF,
+              record_dir=RECORD_DIR, replay_dir=REPLAY_DIR):
+    """Download every URL concurrently and yield a FetchResult for each as it completes.
+
+    The event loop runs on a background thread, so downloads keep progressing while
+    the caller processes earlier results. headers_for(url) may return extra request
+    headers (e.g. conditional-request validators).
+
+    Bodies are handled as raw bytes (content-encoding undone, never charset-decoded).
+    Without sink_for the whole body is returned in FetchResult.content. With it, each
+    successful response is streamed instead: sink_for(url, headers) must return an
+    object with feed(chunk), close() and abort(); bytes chunks are passed to
+    feed() as they arrive and close()'s return value lands in FetchResult.value.
+    A new sink is created for every retry attempt.
+
+    With replay_dir every result comes from that snapshot instead of the network.
+    With record_dir every result is also saved there; conditional request headers
+    are dropped so that the snapshot holds full bodies rather than 304s.
+    """
+    urls = list(urls)
+    if replay_dir:
+        yield from _replay(urls, sink_for, replay_dir)
+        return
+    recorder = None
+    if record_dir:
+        recorder = _Recorder(record_dir)
+        headers_for = None
+        sink_for = recorder.wrap(sink_for) if sink_for else None
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    results = asyncio.run_coroutine_threadsafe(_make_queue(), loop).result()
+    task = asyncio.run_coroutine_threadsafe(
+        _fetch_into(results, urls, headers_for, sink_for, max_connections, max_per_host, retries, backoff), loop
+    )
+    try:
+        for _ in urls:
+            result = asyncio.run_coroutine_threadsafe(results.get(), loop).result()
+            if recorder is not None:
+                recorder.add(result)
+            yield result
+        task.result()
+    finally:
+        if recorder is not None:
+            recorder.save()
+        if not task.done():
+            task.cancel()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        pending = asyncio.all_tasks(loop)
+        if pending:
+            for pending_task in pending:
+                pending_task.cancel()
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.close()
+
+
+async def _make_queue():
+    return asyncio.Queue()
@@ -1,37 +1,268 @@
 #!/usr/bin/env python3
 import csv
 import os
-import re
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import sys
 from datetime import datetime
 
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
-import requests
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from fetcher import fetch_all  # noqa: E402  (shared with adaway)
 
 FILTER_FILE = "filter.list"
 
 COUNTS_HISTORY_FILE = "ip_counts_history.csv"
 GRAPH_FILE = "ip_counts_graph.png"
+NETSET_FILE = "ip_blocklist.netset"  # Minimal covering CIDR set, one prefix per line
+IPSET_FILE = "ip_blocklist.ipset"  # Same set as an `ipset restore` script
+NFT_FILE = "ip_blocklist.nft"  # Same set as an nftables table for `nft -f`
+SET_NAME = "skynet"
+# Fixed, not sized to the list: "create ... -exist" fails if an existing set has other options, and
+# after a swap the live set carries the previous run's temporary set's options
+IPSET_MAXELEM = 1 << 20
 
-MAX_THREADS = 8
 MAX_ENTRIES = 60
 
 
-def fetch_url_content(url):
-    try:
-        print(f"Fetching {url}")
-        resp = requests.get(url, timeout=20)
-        resp.raise_for_status()
-        return resp.text
-    except Exception as e:
-        print(f"[ERROR] Failed to fetch {url}: {e}")
-        return ""
-
-
-def extract_ips_from_text(text):
-    ip_pattern = re.compile(r"\b(?:(?:25[0-5]|2[0-4]\d|1\d{2}|[1-9]?\d)\.){3}" r"(?:25[0-5]|2[0-4]\d|1\d{2}|[1-9]?\d)\b")
-    return set(ip_pattern.findall(text))
+IP_TOKEN_WIDTH = 16  # "255.255.255.255" plus one terminating byte
+IP_BLOCK_LINES = 1 << 18  # Lines parsed per vectorised block, bounding the temporary arrays
+
+# Byte classes for the vectorised parser: octet digits, dots, token terminators (the ASCII whitespace
+# of str.split() plus "#/;"), non-ASCII bytes (possibly Unicode whitespace), anything else is invalid
+OTHER, DIGIT, DOT, END, WIDE = range(5)
+BYTE_CLASS = np.full(256, OTHER, dtype=np.uint8)
+BYTE_CLASS[np.frombuffer(b"0123456789", np.uint8)] = DIGIT
+BYTE_CLASS[ord(".")] = DOT
+BYTE_CLASS[np.frombuffer(b"\t\n\x0b\x0c\r\x1c\x1d\x1e\x1f #/;", np.uint8)] = END
+BYTE_CLASS[0x80:] = WIDE
+
+
+def parse_ipv4_line(line):
+    """(address as a 32-bit int, prefix length) of an "a.b.c.d" or "a.b.c.d/prefix" line, or None.
+
+    The straightforward reference parser; parse_ipv4() must agree with it.
+    """
+    line = line.strip()
+    if not line or line[0] == "#":
+        return None
+    token = line.split(None, 1)[0].partition("#")[0].partition(";")[0]
+    addr, slash, prefix = token.partition("/")
+    parts = addr.split(".")
+    if len(parts) != 4 or not all(part.isascii() and part.isdigit() and len(part) <= 3 for part in parts):
+        return None
+    a, b, c, d = map(int, parts)
+    if a > 255 or b > 255 or c > 255 or d > 255:
+        return None
+    if not slash:
+        prefix = "32"
+    elif not (prefix.isascii() and prefix.isdigit() and len(prefix) <= 2 and int(prefix) <= 32):
+        return None
+    return a << 24 | b << 16 | c << 8 | d, int(prefix)
+
+
+def parse_ipv4(data):
+    """(addresses, prefix lengths) of every IPv4 / CIDR line in data (UTF-8 bytes).
+
+    Returns a uint32 and a uint8 array; a plain address has prefix length 32.
+
+    Line-oriented and vectorised: the first IP_TOKEN_WIDTH bytes of each line
+    that starts with a digit are gathered into a 2-D array, and the dots, octet
+    lengths and octet values are found with whole-array NumPy operations,
+    without a regex or a str per match. Comment and blank lines are skipped;
+    the rare line starting with anything else (e.g. indentation) goes through
+    parse_ipv4_line(), as does a token ending in a non-ASCII byte, which may
+    be Unicode whitespace.
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    starts = np.flatnonzero(buf == ord("\n")) + 1
+    starts = np.concatenate(([0], starts[starts < buf.size])) if buf.size else starts[:0]
+    first = buf[starts]
+    digit_first = (first >= ord("0")) & (first <= ord("9"))
+    slow_starts = [starts[~digit_first & (first != ord("#")) & (first != ord("\n"))]]
+    starts = starts[digit_first]
+
+    # Newline padding ends the last line's token, and every read past a line stays in bounds
+    padded = np.concatenate((buf, np.full(IP_TOKEN_WIDTH + 4, ord("\n"), dtype=np.uint8)))
+    parsed = [parse_ipv4_block(padded, starts[i:i + IP_BLOCK_LINES]) for i in range(0, len(starts), IP_BLOCK_LINES)]
+    slow = []  # (address, prefix) pairs
+    for start in np.concatenate(slow_starts + [deferred for _, _, deferred in parsed]).tolist():
+        end = data.find(b"\n", start)
+        entry = parse_ipv4_line(data[start:end if end >= 0 else len(data)].decode("utf-8", "replace"))
+        if entry is not None:
+            slow.append(entry)
+    slow = np.array(slow, dtype=np.uint32).reshape(-1, 2)
+    addresses = np.concatenate([ips for ips, _, _ in parsed] + [slow[:, 0]])
+    prefixes = np.concatenate([lengths for _, lengths, _ in parsed] + [slow[:, 1].astype(np.uint8)])
+    return addresses, prefixes
+
+
+def parse_ipv4_block(padded, starts):
+    """Vectorised parse of the lines at starts.
+
+    Returns (addresses, prefix lengths) of the valid ones, and the starts of
+    the lines left to parse_ipv4_line().
+    """
+    rows = np.arange(IP_TOKEN_WIDTH, dtype=np.intp)[:, None]
+    # Column j holds one line; row i its i-th byte
+    classes = BYTE_CLASS[padded[rows + starts]]
+    stops = (classes == OTHER) | (classes >= END)
+    length = stops.argmax(axis=0)  # The token ends at the first byte that is not a digit or dot
+    stop_class = classes[length, np.arange(len(starts))]
+    deferred = stop_class == WIDE
+    valid = stop_class == END
+    dot_counts = np.cumsum((classes == DOT) & (rows < length), axis=0, dtype=np.int8)
+    valid &= dot_counts[-1] == 3
+    # Row index of the k-th dot is the number of rows holding fewer than k dots
+    bounds = [np.full(len(starts), -1)] + [(dot_counts < k).sum(axis=0) for k in (1, 2, 3)] + [length]
+    ip = np.zeros(len(starts), dtype=np.uint32)
+    for first, stop in zip(bounds, bounds[1:]):
+        first = first + 1
+        size = stop - first
+        valid &= (size >= 1) & (size <= 3)
+        octet = np.zeros(len(starts), dtype=np.uint32)
+        for j in range(3):
+            digit = padded[starts + first + j].astype(np.uint32) - ord("0")
+            octet = np.where(j < size, octet * 10 + digit, octet)
+        valid &= octet <= 255
+        ip = (ip << 8) | octet
+
+    # An optional "/prefix" of one or two digits, followed by a terminator other than another slash
+    def at(offset):
+        return padded[starts + length + offset]
+
+    slash = at(0) == ord("/")
+    digit = [(at(i) >= ord("0")) & (at(i) <= ord("9")) for i in (1, 2)]
+    closed = [(BYTE_CLASS[at(i)] == END) & (at(i) != ord("/")) for i in (2, 3)]
+    one, two = digit[0] & closed[0], digit[0] & digit[1] & closed[1]
+    prefix = (at(1) - ord("0")).astype(np.uint8)
+    prefix = np.where(two, prefix * 10 + (at(2) - ord("0")), prefix).astype(np.uint8)
+    valid &= ~slash | ((one | two) & (prefix <= 32))
+    prefix = np.where(slash, prefix, 32).astype(np.uint8)
+    # A prefix followed by a non-ASCII byte is decided by the reference parser too
+    deferred |= slash & digit[0] & (BYTE_CLASS[np.where(digit[1], at(3), at(2))] == WIDE)
+    valid &= ~deferred
+    return ip[valid], prefix[valid], starts[deferred]
+
+
+# ---------------- CIDR ranges ----------------
+def cidr_ranges(addresses, prefixes):
+    """Inclusive [first, last] address ranges (uint32 arrays) of CIDR blocks; host bits are ignored."""
+    hostmask = ((np.uint64(1) << (32 - prefixes.astype(np.uint64))) - np.uint64(1)).astype(np.uint32)
+    first = addresses & ~hostmask
+    return first, first | hostmask
+
+
+def merge_ranges(first, last):
+    """Sort inclusive ranges and merge the overlapping and adjacent ones, vectorised.
+
+    Returns the merged (first, last) uint32 arrays, sorted and disjoint.
+    """
+    if not len(first):
+        return first, last
+    order = np.argsort(first, kind="stable")
+    first = first[order].astype(np.int64)
+    reach = np.maximum.accumulate(last[order].astype(np.int64))  # Furthest address covered so far
+    # A new range starts wherever there is a gap after everything before it
+    breaks = np.flatnonzero(first[1:] > reach[:-1] + 1) + 1
+    starts = np.concatenate(([0], breaks))
+    ends = np.concatenate((breaks - 1, [len(first) - 1]))
+    return first[starts].astype(np.uint32), reach[ends].astype(np.uint32)
+
+
+def covered_addresses(first, last):
+    """Exact number of addresses in disjoint inclusive ranges."""
+    return int((last.astype(np.int64) - first.astype(np.int64) + 1).sum())
+
+
+def floor_log2(values):
+    return np.frexp(values.astype(np.float64))[1].astype(np.int64) - 1  # Exact for integers below 2**53
+
+
+def ranges_to_cidrs(first, last):
+    """Decompose disjoint inclusive ranges into the fewest CIDR blocks covering exactly them.
+
+    Every range repeatedly gives up the largest block that is aligned at its
+    current start and still fits, all ranges advancing together in one
+    vectorised step (at most 64 steps). Returns sorted (addresses, prefix lengths).
+    """
+    start = first.astype(np.int64)
+    stop = last.astype(np.int64) + 1
+    addresses, prefixes = [], []
+    while len(start):
+        alignment = np.where(start == 0, 1 << 32, start & -start)  # Lowest set bit of the start address
+        size = np.minimum(alignment, np.left_shift(1, floor_log2(stop - start)))
+        addresses.append(start)
+        prefixes.append(32 - floor_log2(size))
+        start = start + size
+        left = start < stop
+        start, stop = start[left], stop[left]
+    if not addresses:
+        return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.uint8)
+    addresses = np.concatenate(addresses)
+    order = np.argsort(addresses, kind="stable")
+    return addresses[order].astype(np.uint32), np.concatenate(prefixes)[order].astype(np.uint8)
+
+
+def format_cidrs(addresses, prefixes):
+    octets = [((addresses >> shift) & 255).tolist() for shift in (24, 16, 8, 0)]
+    return [
+        f"{a}.{b}.{c}.{d}" if p == 32 else f"{a}.{b}.{c}.{d}/{p}"
+        for a, b, c, d, p in zip(*octets, prefixes.tolist())
+    ]
+
+
+# ---------------- Set outputs ----------------
+def write_file(path, lines):
+    # Through a temp file, so firewall reloads never pick up a half-written set
+    with open(path + ".tmp", "w", encoding="utf-8", newline="\n") as f:
+        f.writelines(line + "\n" for line in lines)
+    os.replace(path + ".tmp", path)
+
+
+def write_netset(cidrs, covered, generated):
+    header = [
+        "#",
+        "# skynet aggregated blocklist",
+        f"# Generated: {generated}",
+        f"# Entries: {len(cidrs)} CIDR blocks covering {covered} unique IPs",
+        "#",
+    ]
+    write_file(NETSET_FILE, header + cidrs)
+
+
+def write_ipset(cidrs):
+    # Fill a temporary set and swap it in, so the live set is never empty
+    if len(cidrs) > IPSET_MAXELEM:
+        print(f"[WARNING] {len(cidrs)} CIDR blocks exceed the ipset maxelem of {IPSET_MAXELEM}; restore will fail.")
+    tmp = f"{SET_NAME}_tmp"
+    lines = [
+        f"create {SET_NAME} hash:net family inet maxelem {IPSET_MAXELEM} -exist",
+        f"create {tmp} hash:net family inet maxelem {IPSET_MAXELEM} -exist",
+        f"flush {tmp}",
+    ]
+    lines += [f"add {tmp} {cidr}" for cidr in cidrs]
+    lines += [f"swap {tmp} {SET_NAME}", f"destroy {tmp}"]
+    write_file(IPSET_FILE, lines)
+
+
+def write_nft(cidrs):
+    # Declaring the table before deleting it makes the file reloadable whether or not it exists
+    lines = [
+        f"table inet {SET_NAME}",
+        f"delete table inet {SET_NAME}",
+        f"table inet {SET_NAME} {{",
+        "    set blocklist {",
+        "        type ipv4_addr",
+        "        flags interval",
+    ]
+    if cidrs:
+        lines.append("        elements = {")
+        lines += [f"            {cidr}," for cidr in cidrs]
+        lines.append("        }")
+    lines += ["    }", "}"]
+    write_file(NFT_FILE, lines)
 
 
 def trim_history():
@@ -55,7 +286,7 @@ def trim_history():
             writer.writerows(data)
 
 
-def log_count_to_history(date_str, unique_count):
+def log_count_to_history(date_str, unique_count, range_count):
     rows = []
     if os.path.isfile(COUNTS_HISTORY_FILE):
         with open(COUNTS_HISTORY_FILE, "r", encoding="utf-8") as f:
@@ -65,16 +296,17 @@ def log_count_to_history(date_str, unique_count):
     for r in rows:
         if r["date"] == date_str:
             r["unique_ips"] = str(unique_count)
+            r["merged_ranges"] = str(range_count)
             updated = True
             break
     if not updated:
-        rows.append({"date": date_str, "unique_ips": str(unique_count)})
+        rows.append({"date": date_str, "unique_ips": str(unique_count), "merged_ranges": str(range_count)})
 
     # sort by date ascending
     rows_sorted = sorted(rows, key=lambda x: x["date"])
 
     with open(COUNTS_HISTORY_FILE, "w", encoding="utf-8", newline="") as f:
-        writer = csv.DictWriter(f, fieldnames=["date", "unique_ips"])
+        writer = csv.DictWriter(f, fieldnames=["date", "unique_ips", "merged_ranges"])
         writer.writeheader()
         writer.writerows(rows_sorted)
 
@@ -130,20 +362,28 @@ def main():
         with open(FILTER_FILE, "r", encoding="utf-8") as f:
             urls = [line.strip() for line in f if line.strip() and not line.startswith("#")]
 
-        unique_ips = set()
-        with ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
-            futures = {executor.submit(fetch_url_content, url): url for url in urls}
-            for future in as_completed(futures):
-                content = future.result()
-                if content:
-                    ips = extract_ips_from_text(content)
-                    unique_ips.update(ips)
+        firsts, lasts = [np.zeros(0, dtype=np.uint32)], [np.zeros(0, dtype=np.uint32)]
+        for result in fetch_all(urls):
+            if not result.ok:
+                print(f"[ERROR] Failed to fetch {result.url}: {result.error}")
+                continue
+            if result.content:
+                first, last = cidr_ranges(*parse_ipv4(result.content))
+                firsts.append(first)
+                lasts.append(last)
 
-        count = len(unique_ips)
+        first, last = merge_ranges(np.concatenate(firsts), np.concatenate(lasts))
+        count = covered_addresses(first, last)
         date_str = datetime.utcnow().strftime("%Y-%m-%d")
-        print(f"Total unique IP addresses found: {count}")
+        print(f"Total unique IP addresses covered: {count} in {len(first)} merged ranges")
+
+        cidrs = format_cidrs(*ranges_to_cidrs(first, last))
+        write_netset(cidrs, count, datetime.utcnow().strftime("%Y-%m-%d %H:%M UTC"))
+        write_ipset(cidrs)
+        write_nft(cidrs)
+        print(f"Wrote {len(cidrs)} CIDR blocks to {NETSET_FILE}, {IPSET_FILE} and {NFT_FILE}")
 
-        log_count_to_history(date_str, count)
+        log_count_to_history(date_str, count, len(first))
         generate_graph()
 
     except Exception as e:
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Differential test: the vectorised IPv4 parser must agree with the reference line parser.
+
+parse_ipv4() is checked against parse_ipv4_line() applied to every line, on
+seeded random documents mixing addresses, CIDR blocks, out-of-range octets,
+five-octet and truncated tokens, comments, trailing text, CRLF line ends,
+NUL bytes, ASCII and Unicode whitespace, invalid UTF-8 and a final line
+without a newline.
+
+    python3 -m unittest test_parse
+    PARSE_FUZZ_CASES=100000 python3 -m unittest test_parse
+"""
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import plot  # noqa: E402
+
+PARSE_FUZZ_CASES = int(os.getenv("PARSE_FUZZ_CASES", "2000"))  # Random documents per test
+PARSE_FUZZ_SEED = int(os.getenv("PARSE_FUZZ_SEED", "1"))
+
+PREFIXES = ["", "", "", "", " ", "\t", "#", "# ", ";", "\xa0", "\x00"]
+OCTETS = ["0", "1", "9", "10", "99", "255", "256", "001", "0255", "999", "", "x", "٣"]
+SUFFIXES = [
+    "", "", "", "/0", "/8", "/24", "/32", "/33", "/024", "/", "/2x", "/24/8", ".5", " # comment", "#x", ";x",
+    " extra", "\r", " \r", "\t", "/24 ", "/24#", "/8;",
+]
+NOISE = [
+    "\x00", "\x1c", "\x1f", "\x0b", "\x0c", " ", "\xa0", "\x85", " ", "　", " ", "é", "\r", "/", "#",
+]
+
+
+def random_line(rng):
+    line = rng.choice(PREFIXES) + ".".join(rng.choice(OCTETS) for _ in range(rng.choice([3, 4, 4, 4, 4, 5])))
+    line += rng.choice(SUFFIXES)
+    for _ in range(rng.choice([0, 0, 0, 1, 2])):
+        at = rng.randint(0, len(line))
+        line = line[:at] + rng.choice(NOISE) + line[at:]
+    return line
+
+
+def random_document(rng):
+    data = ("\r\n" if rng.random() < 0.3 else "\n").join(random_line(rng) for _ in range(rng.randint(0, 40)))
+    data = data.encode("utf-8")
+    if rng.random() < 0.1:
+        at = rng.randint(0, len(data))
+        data = data[:at] + rng.choice([b"\xff", b"\xc2", b"\xe2\x80"]) + data[at:]
+    if rng.random() < 0.5:
+        data += b"\n"
+    return data
+
+
+def reference(data):
+    entries = (plot.parse_ipv4_line(line.decode("utf-8", "replace")) for line in data.split(b"\n"))
+    return sorted(entry for entry in entries if entry is not None)
+
+
+def parsed(data):
+    addresses, prefixes = plot.parse_ipv4(data)
+    return sorted(zip(addresses.tolist(), prefixes.tolist()))
+
+
+class ParseDifferentialTest(unittest.TestCase):
+    def test_vectorised_matches_lines(self):
+        rng = random.Random(PARSE_FUZZ_SEED)
+        for _ in range(PARSE_FUZZ_CASES):
+            data = random_document(rng)
+            with self.subTest(data=data):
+                self.assertEqual(parsed(data), reference(data))
+
+    def test_terminators(self):
+        # NUL is not whitespace to str.split(); Unicode whitespace is, and goes through the reference parser
+        data = "1.2.3.4\x00\n1.1.1.1/1\x00\n5.6.7.8\xa0x\n9.9.9.0/24　\n10.0.0.1".encode("utf-8")
+        self.assertEqual(parsed(data), reference(data))
+        self.assertEqual(len(reference(data)), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()